@@ -0,0 +1,167 @@
+"""
+jobstore.py
+~~~~~~~~~~~
+
+Job stores for the cron scheduler. Jobs can be kept in a local SQLite file, so they keep their next run time across
+restarts and runs missed while the server was down are caught up.
+"""
+import pickle
+import sqlite3
+from threading import Lock
+from typing import Dict, List, Optional
+
+from apscheduler.job import Job
+from apscheduler.jobstores.base import BaseJobStore, ConflictingIdError, JobLookupError
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.util import datetime_to_utc_timestamp, utc_timestamp_to_datetime
+
+# Seconds late a run may be and still count as on time rather than missed
+ON_TIME = 1
+
+
+class CatchUpLimit:
+    """
+    Bounds how many missed runs of a job are caught up; 0 skips them all. Without a limit, every missed run within
+    the job's misfire grace time is run, unless the job coalesces them into one. Runs that are due now always run.
+    """
+    catch_up: Dict[str, int]
+
+    def limit_catch_up(self, jobs: List[Job], now) -> List[Job]:
+        due = []
+        for job in jobs:
+            limit = self.catch_up.get(job.id)
+            if limit is None:
+                due.append(job)
+                continue
+            run_times = job._get_run_times(now)
+            missed = [run_time for run_time in run_times if (now - run_time).total_seconds() > ON_TIME]
+            # Skip all but the latest missed runs
+            keep = run_times[len(missed) - min(limit, len(missed)):]
+            if keep:
+                job.next_run_time = keep[0]
+                due.append(job)
+            elif run_times:
+                # Nothing left to run, so move the job on to its next run after now
+                job.next_run_time = job.trigger.get_next_fire_time(run_times[-1], now)
+                if job.next_run_time is None:
+                    self.remove_job(job.id)
+                else:
+                    self.update_job(job)
+        return due
+
+
+class BoundedMemoryJobStore(CatchUpLimit, MemoryJobStore):
+    """
+    Keeps jobs in memory, so they are lost when the server stops.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.catch_up = {}
+
+    def get_due_jobs(self, now):
+        return self.limit_catch_up(super().get_due_jobs(now), now)
+
+
+class SQLiteJobStore(CatchUpLimit, BaseJobStore):
+    """
+    Keeps jobs in a SQLite file.
+    """
+
+    def __init__(self, path: str, pickle_protocol: int = pickle.HIGHEST_PROTOCOL):
+        super().__init__()
+        self.path = path
+        self.pickle_protocol = pickle_protocol
+        self.catch_up = {}
+        self.connection = None
+        self.lock = Lock()
+
+    def start(self, scheduler, alias):
+        super().start(scheduler, alias)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS jobs '
+                                '(id TEXT PRIMARY KEY, next_run_time REAL, job_state BLOB NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS jobs_next_run_time ON jobs (next_run_time)')
+
+    def lookup_job(self, job_id):
+        rows = self._query('SELECT job_state FROM jobs WHERE id = ?', job_id)
+        return self._reconstitute_job(rows[0][0]) if rows else None
+
+    def get_due_jobs(self, now):
+        return self.limit_catch_up(self._get_jobs('WHERE next_run_time <= ?', datetime_to_utc_timestamp(now)), now)
+
+    def get_next_run_time(self):
+        rows = self._query('SELECT MIN(next_run_time) FROM jobs')
+        return utc_timestamp_to_datetime(rows[0][0]) if rows else None
+
+    def get_all_jobs(self):
+        jobs = self._get_jobs()
+        self._fix_paused_jobs_sorting(jobs)
+        return jobs
+
+    def add_job(self, job):
+        try:
+            self._execute('INSERT INTO jobs VALUES (?, ?, ?)', job.id, datetime_to_utc_timestamp(job.next_run_time),
+                          pickle.dumps(job.__getstate__(), self.pickle_protocol))
+        except sqlite3.IntegrityError:
+            raise ConflictingIdError(job.id)
+
+    def update_job(self, job):
+        cursor = self._execute('UPDATE jobs SET next_run_time = ?, job_state = ? WHERE id = ?',
+                               datetime_to_utc_timestamp(job.next_run_time),
+                               pickle.dumps(job.__getstate__(), self.pickle_protocol), job.id)
+        if cursor and cursor.rowcount == 0:
+            raise JobLookupError(job.id)
+
+    def remove_job(self, job_id):
+        cursor = self._execute('DELETE FROM jobs WHERE id = ?', job_id)
+        if cursor and cursor.rowcount == 0:
+            raise JobLookupError(job_id)
+
+    def remove_all_jobs(self):
+        self._execute('DELETE FROM jobs')
+
+    def shutdown(self):
+        # The scheduler's thread may still be looking for due jobs, and finds none from now on
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def _execute(self, sql: str, *params) -> Optional[sqlite3.Cursor]:
+        """
+        :return: None once the store has been shut down
+        """
+        with self.lock:
+            return self.connection.execute(sql, params) if self.connection is not None else None
+
+    def _query(self, sql: str, *params) -> List[tuple]:
+        with self.lock:
+            return self.connection.execute(sql, params).fetchall() if self.connection is not None else []
+
+    def _reconstitute_job(self, job_state: bytes) -> Job:
+        job_state = pickle.loads(job_state)
+        job_state['jobstore'] = self
+        job = Job.__new__(Job)
+        job.__setstate__(job_state)
+        job._scheduler = self._scheduler
+        job._jobstore_alias = self._alias
+        return job
+
+    def _get_jobs(self, condition: str = '', *params):
+        jobs = []
+        failed = []
+        for job_id, job_state in self._query('SELECT id, job_state FROM jobs ' + condition + ' ORDER BY next_run_time',
+                                             *params):
+            try:
+                jobs.append(self._reconstitute_job(job_state))
+            except BaseException:
+                # e.g. the function it calls no longer exists
+                self._logger.exception('Unable to restore job "%s" -- removing it', job_id)
+                failed.append(job_id)
+        for job_id in failed:
+            self._execute('DELETE FROM jobs WHERE id = ?', job_id)
+        return jobs
+
+    def __repr__(self):
+        return '<{} (path={})>'.format(self.__class__.__name__, self.path)
@@ -5,33 +5,33 @@ models.py
 Contains classes to represent objects created by the parser.
 """
 import os
+import random
+from contextvars import ContextVar
 from copy import deepcopy
-from multiprocessing import Process
-from time import sleep
-from typing import Iterator, Dict, List, Callable
+from inspect import signature
+from time import time
+from typing import Iterator, Dict, List, Callable, NamedTuple, Optional, Any
 from uuid import uuid4
 
 import yaml
 
-from home.core.tasks import scheduler, multiprocessing_run, run
-from home.core.utils import class_from_name, method_from_name, random_string
-from home.settings import TEMPLATE_DIR
-
-drivers = []
-devices = {}
-devices_by_uuid = {}
-interfaces = []
-actions = []
-widgets = {}
-displays = []
+from home.core.state import get_table as get_state_table
+from home.core.sun import SunTrigger
+from home.core.tasks import scheduler, job_store, multiprocessing_run, run, timer, device_queues, EXECUTORS, \
+    async_variant, SyncGroup, TrackedTask
+from home.core.utils import class_from_name, method_from_name, random_string, fingerprint
+from home.settings import TEMPLATE_DIR, LAZY_DRIVERS
 
 
 class YAMLObject(yaml.YAMLObject):
     """
     Base class for YAML objects, simply to print the correct name
     """
+    # Hash of the YAML definition this object was built from; None for objects created in code
+    fingerprint = None
 
     def __setstate__(self, kwargs):
+        self.fingerprint = fingerprint(kwargs)
         self.__init__(**kwargs)
 
     def __repr__(self):
@@ -44,19 +44,23 @@ class Device(YAMLObject):
     """
     yaml_tag = '!device'
 
-    def __init__(self, name: str, driver: str = None, config: Dict = None, group: str = None, widget: bool = True):
+    def __init__(self, name: str, driver: str = None, config: Dict = None, group: str = None, widget: bool = True,
+                 depends_on: List[str] = (), coalesce: List[str] = ()):
         self.name = name
         self.driver = driver
         self.group = group
         self.config = config
+        self.depends_on = list(depends_on)
+        self.coalesce = list(coalesce)
         self.uuid = str(uuid4())
         self.dev = None
-        self.last_task = None
         self.widget = widget
+        self.generated_actions = []
 
     def setup(self) -> None:
         """
-        Set up the driver that this device will use
+        Set up the driver that this device will use. This may run on a worker thread alongside other devices, so
+        the results are only added to the registry by `register`.
         """
         # retrieve the class for driver
         if self.driver:
@@ -71,9 +75,10 @@ class Device(YAMLObject):
                 self.dev = dev(**config_d)
             except Exception as e:
                 raise DeviceSetupError("Failed to configure device '" + self.name + "': " + str(e))
+            # Lets the driver publish its state, even from a copy in another process
+            self.dev._device_uuid = self.uuid
             if self.widget and hasattr(self.dev, 'widget'):
                 self.build_widget(self.dev.widget)
-                widgets.update(self.widget['mapping'])
             if hasattr(self.dev, 'actions'):
                 ta = deepcopy(self.dev.actions)
                 for action in ta:
@@ -82,7 +87,40 @@ class Device(YAMLObject):
                     a = Action(name=action['name'] + " " + self.name, devices=action['devices'])
                     a.setup()
                     a.group = self.group
-                    actions.append(a)
+                    self.generated_actions.append(a)
+
+    def register(self, registry: 'Registry') -> None:
+        """
+        Add this device's widget and generated actions to a registry.
+        """
+        if isinstance(self.widget, dict):
+            registry.widgets.update(self.widget['mapping'])
+        for action in self.generated_actions:
+            registry.add_action(action)
+            action.add_widget()
+
+    def dependencies(self, names) -> set:
+        """
+        Find the devices that must be set up before this one, either declared with `depends_on` or inferred from
+        the config.
+        :param names: Names of the devices that may be depended on.
+        :return: The names of the devices depended on.
+        """
+        for name in self.depends_on:
+            if name not in names:
+                raise DeviceNotFoundError(
+                    "Failed to configure device " + self.name + ": Can't find dependency " + name)
+        return set(self.depends_on) | self.references(names)
+
+    def references(self, names) -> set:
+        """
+        Find other devices this device's config refers to by name, e.g. the weather device used by speech.
+        :param names: Names of the devices that may be referenced.
+        :return: The referenced device names.
+        """
+        config = self.config or {}
+        return {value for value in config.values() if isinstance(value, str) and value in names and
+                value != self.name}
 
     def build_widget(self, config: Dict) -> str:
         mapping = {}
@@ -110,14 +148,26 @@ class Device(YAMLObject):
         self.widget = {'html': html, 'mapping': mapping}
 
 
+FANOUT_MODES = ('parallel', 'sequential', 'synchronized')
+
+
 class MultiDevice(YAMLObject):
+    """
+    Several devices controlled as one. A method call is made on every member: in parallel by default, one after
+    another with `fanout: sequential`, or with `fanout: synchronized`, in parallel and released together once every
+    member is ready.
+    """
     yaml_tag = '!multidevice'
 
-    def __init__(self, name: str, devices: List, widget: bool = True):
+    def __init__(self, name: str, devices: List, widget: bool = True, fanout: str = 'parallel'):
         self.name = name
         self.devices = devices
         self.widget = widget
         self.group = None
+        if fanout not in FANOUT_MODES:
+            raise DeviceSetupError("Unknown fanout '{}' for {}; expected one of {}".format(
+                fanout, name, ", ".join(FANOUT_MODES)))
+        self.fanout = fanout
 
     def __getattr__(self, name):
         if name == 'driver':
@@ -130,13 +180,44 @@ class MultiDevice(YAMLObject):
             #return self.devices[0].dev
             return self
 
-        def method(*args, **kwargs):
-            for device in self.devices:
-                method = method_from_name(device.dev, name)
-                method(*args, **kwargs)
+        def method(*args, **kwargs) -> List[TrackedTask]:
+            if args:
+                # Tasks only take keyword arguments, so name positional ones after the first member's method
+                kwargs = dict(signature(method_from_name(self.devices[0].dev, name)).bind_partial(*args, **kwargs)
+                              .arguments)
+            return self.call(name, **kwargs)
 
+        method.__name__ = name
         return method
 
+    def call(self, method: str, delay: float = 0, origin: str = None, sync: SyncGroup = None,
+             **kwargs) -> List[TrackedTask]:
+        """
+        Call a method on every member, each queued behind that member's other tasks and run with its driver's
+        executor policy.
+        :param sync: Group to release the members' calls with, instead of this device's fanout
+        :return: The members' tasks. With `fanout: sequential`, each member's task is only submitted once the one
+        before it has finished
+        """
+        targets = [(device, method_from_name(device.dev, method)) for device in self.devices]
+        if sync is None and self.fanout == 'synchronized':
+            sync = SyncGroup(len(targets))
+        if sync is not None or self.fanout != 'sequential':
+            return [submit_method(device, target, delay, origin, sync=sync, **kwargs)
+                    for device, target in targets]
+        tasks = []
+
+        def submit_next(_=None):
+            device, target = targets[len(tasks)]
+            task = submit_method(device, target, delay if not tasks else 0, origin, **kwargs)
+            tasks.append(task)
+            # Celery results can't tell us when they finish, so the rest are submitted straight away
+            if len(tasks) < len(targets) and not task.add_done_callback(submit_next):
+                submit_next()
+
+        submit_next()
+        return tasks
+
     def setup(self):
         for device in self.devices:
             device.widget = self.widget
@@ -146,10 +227,18 @@ class MultiDevice(YAMLObject):
             for key in self.widget['mapping']:
                 _map = self.widget['mapping'][key]
                 self.widget['mapping'][key] = (_map[0], method_from_name(self, _map[1].__name__), _map[2], self)
-            widgets.update(self.widget['mapping'])
             self.widget['html'] = self.widget['html'].replace(self.devices[0].name, self.name)
             self.widget['html'] = self.widget['html'].replace('status-' + self.name, 'status-' + self.name.replace(' ', '_'))
 
+    def register(self, registry: 'Registry') -> None:
+        for device in self.devices:
+            device.register(registry)
+        if isinstance(self.widget, dict):
+            registry.widgets.update(self.widget['mapping'])
+
+    def dependencies(self, names) -> set:
+        return set().union(*(device.dependencies(names) for device in self.devices)) - {self.name}
+
 
 class Driver(YAMLObject):
     """
@@ -158,23 +247,51 @@ class Driver(YAMLObject):
     yaml_tag = '!driver'
 
     def __init__(self, module: str, klass: str, name: str = None, interface: str = None, noserialize: bool = False,
-                 static: bool = False):
+                 static: bool = False, executor: str = None, method_executors: Dict[str, str] = None,
+                 poll_interval: float = None):
         self.name = name or klass.lower()
         self.interface = interface
-        self.klass = class_from_name(module, klass)
+        self.module = module
+        self.klass_name = klass
+        self._klass = None
+        if not LAZY_DRIVERS:
+            self._klass = class_from_name(module, klass)
         self.noserialize = noserialize
         self.static = static
+        self.executor = executor
+        self.method_executors = method_executors or {}
+        # Seconds between background polls of its devices' state; None for the default, 0 to not poll
+        self.poll_interval = poll_interval
+        for policy in [executor, *self.method_executors.values()]:
+            if policy is not None and policy not in EXECUTORS:
+                raise ExecutorPolicyError("Unknown executor '{}' for driver {}; expected one of {}".format(
+                    policy, self.name, ", ".join(EXECUTORS)))
+        # A static driver is also a device, added to the registry alongside the driver
+        self.device = Device(self.name, self.name) if static else None
+
+    @property
+    def klass(self):
+        """
+        The driver class, imported when first needed if drivers are loaded lazily.
+        """
+        if self._klass is None:
+            self._klass = class_from_name(self.module, self.klass_name)
+        return self._klass
+
+    def executor_for(self, method: str):
+        """
+        :return: How to run a method of this driver's devices, or None to use the default
+        """
+        return self.method_executors.get(method, self.executor)
 
     def setup(self) -> None:
         """
-        Set up frontend, if it exists
+        Set up frontend, if it exists, and the static device
         """
         if self.interface:
             self.interface = get_interface(self.interface)
-        if self.static:
-            dev = Device(self.name, self.name)
-            dev.setup()
-            devices[self.name] = dev
+        if self.device:
+            self.device.setup()
 
 
 class Action(YAMLObject):
@@ -183,7 +300,8 @@ class Action(YAMLObject):
     """
     yaml_tag = '!action'
 
-    def __init__(self, name, devices: List = [], actions: List = [], jitter: int = 0, button: str = 'btn-info'):
+    def __init__(self, name, devices: List = [], actions: List = [], jitter: int = 0, button: str = 'btn-info',
+                 synchronized: bool = False):
         self.name = name
         self.devices = []
         self.actions = []
@@ -192,6 +310,10 @@ class Action(YAMLObject):
         self.acts = actions
         self.jitter = jitter
         self.button = button
+        # Release device steps due at the same time together, see `SyncGroup` and `MultiDevice.call`
+        self.synchronized = synchronized
+        self.plan = None
+        self.duration = 0
 
     def setup(self) -> None:
         for dev in self.devs:
@@ -210,31 +332,99 @@ class Action(YAMLObject):
             except StopIteration:
                 raise ActionSetupError(
                     "Failed to configure action " + self.name + ": Can't find action " + act)
+
+    def add_widget(self) -> None:
         if self.button:
-            widgets.update({self.name: ('action', self.name, None, self)})
+            get_registry().widgets.update({self.name: ('action', self.name, None, self)})
+
+    def compile(self) -> None:
+        """
+        Flatten this action and the actions it calls into a plan of steps, each with its device method resolved and
+        its delay converted to an offset from the start of the action. An action called more than once in the tree
+        only runs once.
+        """
+        self.plan = []
+        self.duration = self._flatten(0, [self], {self})
 
-    def prerun(self) -> (Iterator[Process], Iterator[int]):
+    def _flatten(self, offset: float, path: List['Action'], seen: set) -> float:
         for action in self.actions:
-            action.run()
-        for callback, args, kwargs in self.subscriptions:
-            callback(*args, **kwargs)
-        for device, config in self.devices:
-            method = method_from_name(device.dev, config['method'])
-            kwargs = config.get('config', {})
-            print("Execute action", config['method'])
-            if device.driver.noserialize or type(device) is MultiDevice:
-                multiprocessing_run(target=method, delay=config.get('delay', 0), **kwargs)
+            if action in path:
+                raise ActionSetupError("Failed to configure action " + path[0].name + ": Actions call each other: " +
+                                       " -> ".join(a.name for a in path + [action]))
+            if action in seen:
                 continue
+            seen.add(action)
+            offset = action._flatten(offset, path + [action], seen)
+        path[0].plan.append(Step(offset, None, self, {}))
+        for device, config in self.devices:
+            offset += config.get('delay', 0)
             try:
-                yield device, method, config.get('delay', 0), kwargs
-            except Exception as e:
-                print("Error", e)
-
-    def run(self, jitter: bool = False):
+                method = method_from_name(device.dev, config['method'])
+            except NotImplementedError:
+                raise ActionSetupError("Failed to configure action " + self.name + ": Device " + device.name +
+                                       " has no method " + config['method'])
+            executor = None
+            if type(device) is Device:
+                executor = device.driver.executor_for(config['method']) or \
+                    ('asyncio' if async_variant(method) else None)
+            path[0].plan.append(Step(offset, device, method, config.get('config', {}), executor))
+        return offset
+
+    def run(self, jitter: bool = False, delay: float = 0, origin: str = None) -> float:
+        """
+        Dispatch every step of this action's plan without waiting for delays to pass.
+        :param jitter: Whether to delay the action by a random part of its jitter
+        :param delay: Seconds from now to start this action
+        :param origin: Who or what triggered the action, recorded with its tasks
+        :return: Seconds from now until the last step is due
+        """
+        if self.plan is None:
+            self.compile()
         if self.jitter and jitter:
-            sleep(self.jitter)
-        for device, method, delay, kwargs in self.prerun():
-            device.last_task = run(method, delay=delay, **kwargs)
+            delay += random.uniform(0, self.jitter)
+        origin = "{} (action {})".format(origin, self.name) if origin else "action " + self.name
+        together = {}
+        for step in self.plan:
+            if self.synchronized and step.device is not None:
+                together.setdefault(step.offset, []).append(step)
+            else:
+                self._dispatch(step, delay, origin)
+        for steps in together.values():
+            size = sum(len(step.device.devices) if type(step.device) is MultiDevice else 1 for step in steps)
+            sync = SyncGroup(size) if size > 1 else None
+            for step in steps:
+                self._dispatch(step, delay, origin, sync)
+        return delay + self.duration
+
+    def _dispatch(self, step: 'Step', delay: float, origin: str, sync: SyncGroup = None) -> None:
+        try:
+            if step.device is None:
+                # Notify anything subscribed to this action or one it called
+                for callback, args, kwargs in step.target.subscriptions:
+                    if delay + step.offset:
+                        timer.call_later(delay + step.offset, callback, *args, **kwargs)
+                    else:
+                        callback(*args, **kwargs)
+                return
+            print("Execute action", step.target.__name__)
+            if type(step.device) is MultiDevice:
+                step.device.call(step.target.__name__, delay + step.offset, origin, sync, **step.kwargs)
+            else:
+                submit_method(step.device, step.target, delay + step.offset, origin, step.executor, sync, **step.kwargs)
+        except Exception as e:
+            print("Error", e)
+
+
+class Step(NamedTuple):
+    """
+    One step of an action's plan: a device method to call, or an action whose subscribers to notify when `device` is
+    None. `offset` is in seconds from the start of the action, and `executor` is the driver's policy for the method.
+    """
+    offset: float
+    device: Optional[Device]
+    target: Any
+    kwargs: Dict
+    executor: Optional[str] = None
 
 
 class Interface(YAMLObject):
@@ -279,50 +469,259 @@ yaml.add_path_resolver('!interface', ['Interface'], dict)
 yaml.add_path_resolver('!display', ['Display'], dict)
 
 
-def add_scheduled_job(job: Dict):
+def run_action(action_name: str, jitter: bool = False) -> None:
+    """
+    Run an action by name, resolved when the job fires so scheduled jobs survive config reloads.
+    """
+    get_action(action_name).run(jitter=jitter, origin='cron')
+
+
+def run_device_method(device_name: str, method_name: str, **kwargs) -> None:
+    """
+    Call a method on a device by name, resolved when the job fires so scheduled jobs survive config reloads.
+    """
+    method_from_name(get_device(device_name).dev, method_name)(**kwargs)
+
+
+def submit_method(device: Device, target: Callable, delay: float = 0, origin: str = None, executor: str = None,
+                  sync: SyncGroup = None, **kwargs) -> TrackedTask:
+    """
+    Run a device's method behind the device's other tasks, with its driver's executor policy unless `executor` is
+    given.
+    """
+    executor = executor or device.driver.executor_for(target.__name__)
+    if executor is None and device.driver.noserialize:
+        return multiprocessing_run(target, delay, device.name, origin, sync, **kwargs)
+    return run(target, delay=delay, device=device.name, origin=origin, executor=executor, sync=sync, **kwargs)
+
+
+def scheduled_job_spec(job: Dict) -> Dict:
+    """
+    Resolve a cron job definition into the arguments to schedule it with, checking its action or device exists.
+    The 'sun' trigger fires at a sun `event` each day, `offset` seconds after it. Jobs running an action with jitter
+    are delayed by a random part of it.
+    :param job: The job definition from the config file.
+    :return: Keyword arguments for `scheduler.add_job`, with the job's ID being a hash of its definition, and the
+    number of missed runs to catch up as `catch_up`. An `id` from the config is kept as the job's name, unless it has
+    one, and changing the rest of the definition still replaces the job.
+    """
+    job = dict(job)
     if job.get('action'):
-        scheduler.add_job(get_action(job.pop('action')).run,
-                          trigger=job.pop('trigger', 'cron'),
-                          kwargs=dict(jitter=True), **job)
+        action = get_action(job['action'])
+        # The trigger delays each run by a random part of the action's jitter, so no worker is held waiting it out
+        if action.jitter and job.get('trigger', 'cron') in ('cron', 'interval', 'sun'):
+            job.setdefault('jitter', action.jitter)
+    job_id = fingerprint(job)
+    if 'id' in job:
+        job.setdefault('name', job.pop('id'))
+    trigger = job.pop('trigger', 'cron')
+    if trigger == 'sun':
+        trigger = SunTrigger(job.pop('event', 'sunset'), job.pop('offset', 0), job.pop('jitter', None))
+    job.setdefault('catch_up', None)
+    if job.pop('action', None):
+        return dict(func=run_action, trigger=trigger, args=[action.name], id=job_id, **job)
     elif job.get('device'):
         device = get_device(job.pop('device'))
-        method = method_from_name(device.dev, job.pop('method'))
-        scheduler.add_job(method, trigger=job.pop('trigger', 'cron'), kwargs=job.pop('config', {}), **job)
+        method_name = job.pop('method')
+        method_from_name(device.dev, method_name)
+        return dict(func=run_device_method, trigger=trigger, args=[device.name, method_name],
+                    kwargs=job.pop('config', {}), id=job_id, **job)
 
 
-def get(name: str, search: List):
+def sync_scheduled_jobs(jobs: List[Dict]) -> None:
+    """
+    Schedule the given cron jobs and remove any scheduled job that is no longer defined. Jobs that did not change
+    keep their next run time, also across restarts when the job store is persistent. Every job is checked before the
+    scheduler is touched. The scheduler is started once its jobs are in sync.
+    """
+    specs = [scheduled_job_spec(job) for job in jobs]
+    specs = [spec for spec in specs if spec]
+    job_ids = {spec['id'] for spec in specs}
+    job_store.catch_up = {spec['id']: spec.pop('catch_up') for spec in specs}
+    for spec in specs:
+        if not scheduler.get_job(spec['id']):
+            scheduler.add_job(**spec)
+    for job in scheduler.get_jobs():
+        if job.id not in job_ids:
+            job.remove()
+    scheduler.resume()
+
+
+def get(name: str, index: Dict):
     try:
-        return next(_ for _ in search if _.name == name)
-    except StopIteration:
-        raise StopIteration("Couldn't find " + name + " in " + str(search))
+        return index[name.casefold()]
+    except KeyError:
+        raise StopIteration("Couldn't find " + name + " in " + str(list(index.values())))
+
+
+class Registry:
+    """
+    Every object created from one config load, with indexes for fast lookups. The parser builds a complete new
+    registry and swaps it in with a single assignment, so readers holding a registry always see a consistent
+    snapshot.
+    """
+
+    def __init__(self):
+        self.drivers = []
+        self.devices = {}
+        self.devices_by_uuid = {}
+        self.interfaces = []
+        self.actions = []
+        self.widgets = {}
+        self.displays = []
+        # Case-folded name indexes, maintained as objects are registered
+        self.action_index = {}
+        self.driver_index = {}
+        self.interface_index = {}
+        self.display_index = {}
+        # Group and interface indexes, built once every object is registered by `build_indexes`
+        self.device_groups = {}
+        self.action_groups = {}
+        self.interface_devices = {}
+
+    def add_device(self, device: Device) -> None:
+        self.devices[device.name] = device
+        self.devices_by_uuid[device.uuid] = device
+
+    def add_action(self, action: Action) -> None:
+        self.actions.append(action)
+        self.action_index.setdefault(action.name.casefold(), action)
+
+    def add_driver(self, driver: Driver) -> None:
+        self.drivers.append(driver)
+        self.driver_index.setdefault(driver.name.casefold(), driver)
+
+    def add_interface(self, interface: Interface) -> None:
+        self.interfaces.append(interface)
+        self.interface_index.setdefault(interface.name.casefold(), interface)
+
+    def add_display(self, display: Display) -> None:
+        self.displays.append(display)
+        self.display_index.setdefault(display.name.casefold(), display)
+
+    def build_indexes(self) -> None:
+        """
+        Build the group and interface indexes once every device and action has been set up.
+        """
+        for device in self.devices.values():
+            self.device_groups.setdefault(device.group, []).append(device)
+            driver = device.driver
+            if driver and getattr(driver, 'interface', None):
+                self.interface_devices.setdefault(driver.interface.name, []).append(device)
+        for action in self.actions:
+            self.action_groups.setdefault(action.group, []).append(action)
+
+    def get_device_by_uuid(self, uuid: str) -> Device:
+        return self.devices_by_uuid[uuid]
+
+    def get_device(self, name: str) -> Device:
+        return self.devices[name]
+
+    def get_devices_by_group(self, group_name: str) -> Iterator[Device]:
+        return iter(self.device_groups.get(group_name, ()))
+
+    def get_devices_by_interface(self, interface: Interface) -> List[Device]:
+        return self.interface_devices.get(interface.name, [])
+
+    def get_actions_by_group(self) -> Dict[str, List[Action]]:
+        return self.action_groups
+
+    def get_action(self, action_name: str) -> Action:
+        try:
+            return self.action_index[action_name.casefold()]
+        except KeyError:
+            raise StopIteration("Couldn't find action " + action_name)
+
+    def get_driver(self, driver_name: str) -> Driver:
+        return get(driver_name, self.driver_index)
+
+    def get_interface(self, interface_name: str) -> Interface:
+        return get(interface_name, self.interface_index)
+
+    def get_display(self, display_name: str) -> Display:
+        return get(display_name, self.display_index)
+
+
+registry = Registry()
+# The registry being built by the parser, visible only to code running as part of that config load
+loading_registry = ContextVar('loading_registry', default=None)
+
+
+def get_registry() -> Registry:
+    """
+    Get the registry for the active config, or the one being built if called while the config is loading.
+    """
+    return loading_registry.get() or registry
+
+
+def swap_registry(new: Registry) -> None:
+    global registry
+    registry = new
+    device_queues.coalesced = {device.name: set(device.coalesce) for device in new.devices.values()
+                               if type(device) is Device and device.coalesce}
+
+
+def publish_state(driver, state: Any, key: str = 'state') -> None:
+    """
+    Share a driver's state with every process, keyed by its device's UUID. Does nothing if the driver isn't a
+    configured device or shared memory isn't available.
+    :param key: What the state is; 'state' is the answer to `get_state`, which clients are sent as the device's state
+    """
+    uuid = getattr(driver, '_device_uuid', None)
+    table = get_state_table()
+    if uuid and table:
+        try:
+            table.publish(uuid, key, state)
+        except ValueError as e:
+            print("Couldn't publish state:", e)
+
+
+def read_state(device: Device, max_age: float = None, key: str = 'state') -> Optional[Any]:
+    """
+    :param max_age: Ignore state published longer ago than this, in seconds
+    :param key: Which of the device's published states to read
+    :return: The state last published by a device's driver, from any process
+    """
+    table = get_state_table()
+    entry = table.read(device.uuid, key) if table and type(device) is Device else None
+    if entry and (max_age is None or time() - entry[1] <= max_age):
+        return entry[0]
 
 
 def get_device_by_uuid(uuid: str) -> Device:
-    return devices_by_uuid[uuid]
+    return get_registry().get_device_by_uuid(uuid)
 
 
 def get_device(name: str) -> Device:
-    return devices[name]
+    return get_registry().get_device(name)
 
 
 def get_devices_by_group(group_name: str) -> Iterator[Device]:
-    return (device for device in devices.values() if device.group == group_name)
+    return get_registry().get_devices_by_group(group_name)
+
+
+def get_devices_by_interface(interface: Interface) -> List[Device]:
+    return get_registry().get_devices_by_interface(interface)
+
+
+def get_actions_by_group() -> Dict[str, List[Action]]:
+    return get_registry().get_actions_by_group()
 
 
 def get_action(action_name: str) -> Action:
-    return next(action for action in actions if action.name.lower() == action_name.lower())
+    return get_registry().get_action(action_name)
 
 
 def get_driver(driver_name: str) -> Driver:
-    return get(driver_name, drivers)
+    return get_registry().get_driver(driver_name)
 
 
 def get_interface(interface_name: str) -> Interface:
-    return get(interface_name, interfaces)
+    return get_registry().get_interface(interface_name)
 
 
 def get_display(display_name: str) -> Display:
-    return get(display_name, displays)
+    return get_registry().get_display(display_name)
 
 
 def subscribe_to_action(action_name: str, callback: Callable, *args, **kwargs):
@@ -358,5 +757,13 @@ class ActionSetupError(YAMLConfigParseError):
     pass
 
 
+class ExecutorPolicyError(YAMLConfigParseError):
+    pass
+
+
+class DependencyCycleError(YAMLConfigParseError):
+    pass
+
+
 class WidgetSetupError(YAMLConfigParseError):
     pass
@@ -5,82 +5,368 @@ parser.py
 
 Parses YAML configuration files.
 """
+import hashlib
+import io
+import os
+import pickle
 import re
+from concurrent.futures.thread import ThreadPoolExecutor
+from contextvars import copy_context
+from threading import Lock
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterable, Set, Tuple
 
 import yaml
 
-from home.core.models import drivers, devices, actions, interfaces, add_scheduled_job, widgets, get_action, \
-    WidgetSetupError, displays, devices_by_uuid, DuplicateDeviceNameError
-from home.core.utils import clear_scheduled_jobs
+from home.core import models, state
+from home.core.models import WidgetSetupError, DuplicateDeviceNameError, sync_scheduled_jobs, Action, MultiDevice, \
+    Registry, loading_registry, swap_registry, DependencyCycleError, Device, Driver, Interface, Display
+from home.core.poller import poller
+from home.core.workers import worker_pool
+from home.settings import MAX_SETUP_THREADS, CONFIG_CACHE
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 bad_regex = re.compile(r'!!python\/')
+# Only one config load may build a registry at a time
+parse_lock = Lock()
+# Bump when the cached structure changes shape
+CACHE_VERSION = 1
+CONFIG_CLASSES = {klass.yaml_tag: klass for klass in (Device, MultiDevice, Driver, Action, Interface, Display)}
+# Types that may appear in a config structure besides the builtins, e.g. dates for cron jobs
+CACHE_GLOBALS = {('datetime', 'date'), ('datetime', 'datetime'), ('datetime', 'time'), ('datetime', 'timedelta'),
+                 ('datetime', 'timezone')}
 
 
-def parse(file: str = None, data: str = None):
+class ConfigLoader(SafeLoader):
+    """
+    Safe YAML loader that reads config objects as `(tag, definition)` tuples instead of instantiating them, so the
+    result only holds plain data and can be cached.
+    """
+
+
+def construct_config_object(loader: ConfigLoader, node: yaml.MappingNode) -> Tuple[str, Dict]:
+    return node.tag, loader.construct_mapping(node, deep=True)
+
+
+for tag in CONFIG_CLASSES:
+    ConfigLoader.add_constructor(tag, construct_config_object)
+
+
+class CacheUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if (module, name) not in CACHE_GLOBALS:
+            raise pickle.UnpicklingError("Unexpected type in config cache: {}.{}".format(module, name))
+        return super().find_class(module, name)
+
+
+def parse(file: str = None, data: str = None, incremental: bool = False, replica: bool = False,
+          only: Iterable[str] = None) -> float:
     """
     Load device config from a YAML file or blob.
     :param file: File to parse
     :param data: YAML text to parse
+    :param incremental: Diff against the loaded config, only rebuilding objects whose definition changed
+    :param replica: Load the config into a worker process, which doesn't schedule cron jobs
+    :param only: Names of the only devices to set up, along with the devices and drivers they need; actions and
+    displays are skipped
+    :return: Time taken to load the config, in seconds
     """
+    start = perf_counter()
     if file:
         with open(file) as f:
             d = f.read()
     else:
         d = data
-    if re.search(bad_regex, d):
+    y, source = load(d)
+    y = instantiate(y)
+    if only is not None:
+        y = _subset(y, set(only))
+    loaded = perf_counter()
+    with parse_lock:
+        old = models.registry if incremental else Registry()
+        new = Registry()
+        token = loading_registry.set(new)
+        try:
+            reused = _build(y, new, old, schedule=not replica)
+            # Swap in the new config only once it is complete; until then, readers keep using the old one
+            swap_registry(new)
+        finally:
+            loading_registry.reset(token)
+        if not replica:
+            state.refresh(device.uuid for device in new.devices.values() if type(device) is Device)
+            worker_pool.refresh(d, new)
+            poller.refresh(new)
+    elapsed = perf_counter() - start
+    print("Loaded config in {:.3f}s (parse {:.3f}s from {}, setup {:.3f}s, {} objects reused)".format(
+        elapsed, loaded - start, source, elapsed - (loaded - start), reused))
+    return elapsed
+
+
+def load(data: str) -> Tuple[Dict, str]:
+    """
+    Parse YAML config text into plain data, using the compiled config cache if it was built from the same text.
+    :param data: YAML text to parse
+    :return: The parsed structure and where it came from, 'cache' or 'yaml'
+    """
+    digest = hashlib.sha256(data.encode()).hexdigest()
+    y = read_cache(digest)
+    if y is not None:
+        return y, 'cache'
+    if re.search(bad_regex, data):
         print("Unsafe expression detected in YAML input! Bailing...")
         raise Exception("Unsafe expression detected in YAML input.")
-    drivers.clear()
-    devices.clear()
-    actions.clear()
-    displays.clear()
-    interfaces.clear()
-    widgets.clear()
-    clear_scheduled_jobs()
-    y = yaml.load(d, Loader=yaml.Loader)
+    y = yaml.load(data, Loader=ConfigLoader)
+    write_cache(digest, y)
+    return y, 'yaml'
+
+
+def read_cache(digest: str):
+    if not CONFIG_CACHE:
+        return None
+    try:
+        with open(CONFIG_CACHE, 'rb') as f:
+            cache = CacheUnpickler(io.BytesIO(f.read())).load()
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError, TypeError):
+        return None
+    if isinstance(cache, dict) and cache.get('version') == CACHE_VERSION and cache.get('digest') == digest:
+        return cache['config']
+
+
+def write_cache(digest: str, y: Dict) -> None:
+    if not CONFIG_CACHE:
+        return
+    try:
+        with open(CONFIG_CACHE + '.tmp', 'wb') as f:
+            pickle.dump({'version': CACHE_VERSION, 'digest': digest, 'config': y}, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(CONFIG_CACHE + '.tmp', CONFIG_CACHE)
+    except OSError as e:
+        print("Couldn't write config cache:", e)
+
+
+def instantiate(node: Any) -> Any:
+    """
+    Create the config objects in a parsed structure, the same way the YAML loader would.
+    """
+    if isinstance(node, tuple):
+        tag, definition = node
+        obj = CONFIG_CLASSES[tag].__new__(CONFIG_CLASSES[tag])
+        obj.__setstate__(instantiate(definition))
+        return obj
+    elif isinstance(node, dict):
+        return {key: instantiate(value) for key, value in node.items()}
+    elif isinstance(node, list):
+        return [instantiate(value) for value in node]
+    return node
+
+
+def _build(y: dict, registry: Registry, old: Registry, schedule: bool = True) -> int:
+    """
+    Populate a registry from parsed YAML, reusing objects from the old registry whose definition is unchanged.
+    :param schedule: Whether to schedule the config's cron jobs
+    :return: The number of objects reused
+    """
+    reused = 0
     for interface in y['interfaces']:
-        interfaces.append(interface)
+        registry.add_interface(_unchanged(interface, old.interface_index.get(interface.name.casefold())) or interface)
     print("Installed drivers:")
+    drivers = []
+    pending = {}
     for driver in y['installed_drivers']:
+        previous = _unchanged(driver, old.driver_index.get(driver.name.casefold()))
+        if previous:
+            driver = previous
+            if driver.interface:
+                driver.interface = registry.get_interface(driver.interface.name)
+            reused += 1
+        else:
+            pending[driver.name] = (driver.setup, set())
+        registry.add_driver(driver)
+        if driver.device:
+            registry.add_device(driver.device)
         drivers.append(driver)
-        driver.setup()
+    _setup_concurrently(pending)
+    for driver in drivers:
+        if driver.device:
+            driver.device.register(registry)
         print(driver)
     print("Active devices:")
+    devices = []
+    names = set()
+    candidates = {}
     for group in y['devices']:
         for device in y['devices'][group]:
-            if device.name in devices:
+            if device.name in registry.devices or device.name in names:
                 raise DuplicateDeviceNameError(device.name)
+            names.add(device.name)
             device.group = group
-            devices[device.name] = device
-            devices_by_uuid[device.uuid] = device
-            device.setup()
-            print(device)
+            previous = _unchanged(device, old.devices.get(device.name))
+            if previous and _driver_kept(previous, registry):
+                candidates[device.name] = previous
+            devices.append(device)
+    names |= registry.devices.keys()
+    dependencies = {device.name: device.dependencies(names) for device in devices}
+    # A device is only kept if nothing it depends on was rebuilt, including static devices of rebuilt drivers
+    rebuilt = {driver.name for driver in drivers if driver.device and driver.name in pending}
+    rebuilt |= dependencies.keys() - candidates.keys()
+    changed = True
+    while changed:
+        changed = False
+        for name in list(candidates):
+            if dependencies[name] & rebuilt:
+                del candidates[name]
+                rebuilt.add(name)
+                changed = True
+    pending = {}
+    for i, device in enumerate(devices):
+        if device.name in candidates:
+            devices[i] = candidates[device.name]
+            reused += 1
+        else:
+            pending[device.name] = (device.setup, dependencies[device.name])
+        registry.add_device(devices[i])
+    _setup_concurrently(pending)
+    for device in devices:
+        device.register(registry)
+        print(device)
     print("Configured actions:")
-    if y.get('actions'):
-        for group in y['actions']:
-            try:
-                for action in y['actions'][group]:
-                    action.group = group
-                    actions.append(action)
-                    action.setup()
-                    print(action.devices)
-            except TypeError:
-                print(group, "group defined with no actions. Skipping...")
+    actions = []
+    candidates = {}
+    for group in y.get('actions') or {}:
+        try:
+            for action in y['actions'][group]:
+                action.group = group
+                previous = _unchanged(action, old.action_index.get(action.name.casefold()))
+                if previous and all(registry.devices.get(device.name) is device for device, _ in previous.devices):
+                    candidates[action.name] = previous
+                actions.append(action)
+        except TypeError:
+            print(group, "group defined with no actions. Skipping...")
+    # An action is only kept if every action it calls was kept too
+    changed = True
+    while changed:
+        changed = False
+        for name, previous in list(candidates.items()):
+            if not all(candidates.get(act.name) is act or registry.action_index.get(act.name.casefold()) is act
+                       for act in previous.actions):
+                del candidates[name]
+                changed = True
+    for i, action in enumerate(actions):
+        if action.name in candidates:
+            actions[i] = candidates[action.name]
+            reused += 1
+        registry.add_action(actions[i])
+    # Actions are set up once all of them are registered, so they may call actions defined further down
+    for action in actions:
+        if action.name not in candidates:
+            action.setup()
+        action.add_widget()
+        print(action.devices)
+    for action in registry.actions:
+        if action.plan is None:
+            action.compile()
     if y.get('displays'):
         for group in y['displays']:
             for display in y['displays'][group]:
                 display.group = group
-                displays.append(display)
+                registry.add_display(_unchanged(display, old.display_index.get(display.name.casefold())) or display)
     # During device setup, couldn't pair widget buttons to actions since they didn't exist yet. Here, we match up
     #  the actions and save the actual action object in the widget dict
+    widgets = registry.widgets
     for w in widgets:
         wi = widgets[w]
         if wi[0] == 'action':
             try:
-                act = get_action(wi[1])
+                act = registry.get_action(wi[1].name if isinstance(wi[1], Action) else wi[1])
                 widgets[w] = (wi[0], act, wi[2], wi[3])
             except StopIteration:
                 raise WidgetSetupError("Failed to find action '{}' while configuring widget".format(widgets[w][1]))
-    if y.get('cron'):
-        for job in y['cron']:
-            add_scheduled_job(job)
+    registry.build_indexes()
+    if schedule:
+        sync_scheduled_jobs(y.get('cron') or [])
+    return reused
+
+
+def _subset(y: dict, only: Set[str]) -> dict:
+    """
+    Cut parsed config down to some devices, the devices they depend on and their drivers, e.g. for worker processes
+    that only run some drivers' methods, so no other device is set up there.
+    """
+    devices = {device.name: device for group in y['devices'] for device in y['devices'][group]
+               if type(device) is Device}
+    static = {driver.name for driver in y['installed_drivers'] if driver.static}
+    names = devices.keys() | static
+    wanted = set()
+    pending = [name for name in only if name in names]
+    while pending:
+        name = pending.pop()
+        if name not in wanted:
+            wanted.add(name)
+            if name in devices:
+                pending.extend(devices[name].dependencies(names))
+    drivers = {devices[name].driver for name in wanted if name in devices} | (wanted & static)
+    return dict(y, installed_drivers=[driver for driver in y['installed_drivers'] if driver.name in drivers],
+                devices={group: [device for device in y['devices'][group] if device.name in wanted]
+                         for group in y['devices']},
+                actions=None, displays=None, cron=None)
+
+
+def _unchanged(new, old):
+    """
+    Return the previously loaded object if its definition and group match the newly parsed one.
+    """
+    if old is not None and type(old) is type(new) and old.fingerprint and old.fingerprint == new.fingerprint \
+            and getattr(old, 'group', None) == getattr(new, 'group', None):
+        return old
+
+
+def _driver_kept(device, registry: Registry) -> bool:
+    """
+    An unchanged device may only be kept if the driver it was set up with was kept too.
+    """
+    members = device.devices if type(device) is MultiDevice else [device]
+    return all(not member.driver or registry.driver_index.get(member.driver.name.casefold()) is member.driver
+               for member in members)
+
+
+def _setup_concurrently(pending: Dict[str, Tuple[Callable, Set[str]]]) -> None:
+    """
+    Run setup functions on a bounded worker pool, each one only after the ones it depends on have finished.
+    Setup errors are raised in config order.
+    :param pending: Setup function and the names of its dependencies, by name
+    """
+    order = []
+    visiting = set()
+
+    # Dependencies that are not pending have already been set up
+    dependencies = {name: depends_on & pending.keys() for name, (_, depends_on) in pending.items()}
+
+    def visit(name, path):
+        if name in order:
+            return
+        if name in visiting:
+            raise DependencyCycleError("Dependency cycle between devices: " + " -> ".join(path + [name]))
+        visiting.add(name)
+        for dependency in sorted(dependencies[name]):
+            visit(dependency, path + [name])
+        order.append(name)
+
+    for name in pending:
+        visit(name, [])
+    futures = {}
+
+    def run_after(name):
+        for dependency in dependencies[name]:
+            futures[dependency].result()
+        pending[name][0]()
+
+    # Dependencies are submitted before their dependents, so a worker waiting on one never blocks it from running
+    with ThreadPoolExecutor(max_workers=MAX_SETUP_THREADS) as pool:
+        for name in order:
+            futures[name] = pool.submit(copy_context().run, run_after, name)
+    for name in pending:
+        futures[name].result()
+
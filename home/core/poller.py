@@ -0,0 +1,95 @@
+"""
+poller.py
+~~~~~~~~~
+
+Polls the state of devices in the background, so clients showing it read a recent state instead of each asking the
+device.
+"""
+import random
+from threading import Lock
+from typing import Callable, Dict, Optional
+
+from home.core.models import Device, Registry, publish_state
+from home.core.tasks import timer, thread_runner, call
+from home.settings import STATE_POLL_INTERVAL, STATE_MAX_AGE
+
+# Seconds to wait for a device's state before giving up until the next poll
+POLL_TIMEOUT = 10
+
+
+class StatePoller:
+    """
+    Refreshes the state of every device whose driver has `get_state`, each at its driver's `poll_interval`. States
+    are published to the shared state table, and subscribers are told when a device's state changed.
+    """
+
+    def __init__(self):
+        # Bumped when the config changes, so polls of the previous config stop
+        self.generation = 0
+        self.intervals = {}
+        self.states = {}
+        self.failing = set()
+        self.subscriptions = []
+        self.lock = Lock()
+
+    def subscribe(self, callback: Callable[[Device, Dict], None]) -> None:
+        """
+        :param callback: Called with a device and its new state whenever a poll finds that it changed
+        """
+        self.subscriptions.append(callback)
+
+    def max_age(self, device: Device) -> float:
+        """
+        Seconds a device's published state is recent enough to show instead of asking the device. States of polled
+        devices stay fresh for two intervals, so one slow poll doesn't send every client to the device.
+        """
+        interval = self.intervals.get(device.uuid)
+        return max(STATE_MAX_AGE, interval * 2) if interval else STATE_MAX_AGE
+
+    def refresh(self, registry: Registry) -> None:
+        """
+        Poll the devices of a newly loaded config.
+        """
+        devices = [device for device in registry.devices.values() if self._interval(device)]
+        with self.lock:
+            self.generation += 1
+            generation = self.generation
+            self.intervals = {device.uuid: self._interval(device) for device in devices}
+            self.states = {uuid: state for uuid, state in self.states.items() if uuid in self.intervals}
+        for device in devices:
+            # Spread the first polls out, so they don't all hit the network at once
+            timer.call_later(random.uniform(0, self.intervals[device.uuid]), thread_runner, self._poll, generation,
+                             device)
+
+    @staticmethod
+    def _interval(device) -> Optional[float]:
+        if type(device) is not Device or device.dev is None or not hasattr(device.dev, 'get_state'):
+            return None
+        interval = getattr(device.driver, 'poll_interval', None)
+        return STATE_POLL_INTERVAL if interval is None else interval
+
+    def _poll(self, generation: int, device: Device) -> None:
+        if generation != self.generation:
+            return
+        try:
+            state = call(device.dev.get_state, timeout=POLL_TIMEOUT)
+        except Exception as e:
+            # Only report a device once until it answers again
+            if device.uuid not in self.failing:
+                self.failing.add(device.uuid)
+                print("Couldn't poll the state of {}: {}".format(device.name, e))
+        else:
+            self.failing.discard(device.uuid)
+            if state is not None:
+                publish_state(device.dev, state)
+                if device.uuid not in self.states or self.states[device.uuid] != state:
+                    self.states[device.uuid] = state
+                    for callback in self.subscriptions:
+                        callback(device, state)
+        finally:
+            interval = self.intervals.get(device.uuid) if generation == self.generation else None
+            if interval:
+                timer.call_later(interval, thread_runner, self._poll, generation, device)
+
+
+poller = StatePoller()
@@ -0,0 +1,118 @@
+"""
+profiling.py
+~~~~~~~~~~~~
+
+Measures how long each module takes to import during startup, and how long tasks take to dispatch.
+"""
+import sys
+from importlib.abc import MetaPathFinder
+from time import perf_counter
+from typing import Dict, Iterable, List, Tuple
+
+
+class TimedLoader:
+    """
+    Wraps a module loader to time executing the module.
+    """
+
+    def __init__(self, loader, profiler: 'ImportProfiler', name: str):
+        self.loader = loader
+        self.profiler = profiler
+        self.name = name
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        self.profiler.start(self.name)
+        try:
+            self.loader.exec_module(module)
+        finally:
+            self.profiler.stop(self.name)
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+
+class ImportProfiler(MetaPathFinder):
+    """
+    Records the time spent importing each module, both in total and excluding the modules it imports.
+    """
+
+    def __init__(self):
+        self.times = {}
+        self.stack = []
+
+    def install(self) -> None:
+        sys.meta_path.insert(0, self)
+
+    def uninstall(self) -> None:
+        sys.meta_path.remove(self)
+
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = TimedLoader(spec.loader, self, fullname)
+                return spec
+        return None
+
+    def start(self, name: str) -> None:
+        self.stack.append([name, perf_counter(), 0.0])
+
+    def stop(self, name: str) -> None:
+        _, started, children = self.stack.pop()
+        total = perf_counter() - started
+        self.times[name] = (total, total - children)
+        if self.stack:
+            self.stack[-1][2] += total
+
+    def report(self, limit: int = 30) -> List[Tuple[str, float, float]]:
+        """
+        :return: Module name, total and self import time in seconds, slowest first
+        """
+        times = sorted(self.times.items(), key=lambda t: t[1][0], reverse=True)
+        return [(name, total, own) for name, (total, own) in times[:limit]]
+
+    def print_report(self, limit: int = 30) -> None:
+        print("{:>10} {:>10}  module".format("total ms", "self ms"))
+        for name, total, own in self.report(limit):
+            print("{:>10.1f} {:>10.1f}  {}".format(total * 1000, own * 1000, name))
+
+
+def noop() -> None:
+    pass
+
+
+def benchmark_dispatch(executors: Iterable[str] = None, rounds: int = 200) -> Dict[str, Tuple[float, float]]:
+    """
+    Time running a task that does nothing with each executor, from submitting it until its result is back.
+    :param executors: Executors to time; all except Celery unless ASYNC_MODE is 'celery', and except workers, which
+    only run device methods
+    :return: Mean and slowest time in seconds, by executor
+    """
+    from home.core.tasks import run, EXECUTORS, ASYNC_MODE
+
+    if executors is None:
+        executors = [executor for executor in EXECUTORS
+                     if executor != 'worker' and (executor != 'celery' or ASYNC_MODE == 'celery')]
+    results = {}
+    for executor in executors:
+        # Start the pool's workers before timing
+        run(noop, executor=executor).result(30)
+        times = []
+        for _ in range(rounds):
+            started = perf_counter()
+            run(noop, executor=executor).result(30)
+            times.append(perf_counter() - started)
+        results[executor] = (sum(times) / len(times), max(times))
+    return results
+
+
+def print_benchmark(results: Dict[str, Tuple[float, float]]) -> None:
+    print("{:>10} {:>10}  executor".format("mean ms", "max ms"))
+    for executor, (mean, slowest) in results.items():
+        print("{:>10.3f} {:>10.3f}  {}".format(mean * 1000, slowest * 1000, executor))
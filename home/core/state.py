@@ -0,0 +1,274 @@
+"""
+state.py
+~~~~~~~~
+
+A table of device state in shared memory, so state that a driver publishes from a worker process can be read by the
+web process without asking the worker for it.
+"""
+import atexit
+import json
+import os
+import struct
+import tempfile
+from contextlib import contextmanager
+from threading import Lock
+from time import time
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
+from uuid import UUID
+
+from home.settings import STATE_SLOT_SIZE
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Names the current table, so worker processes started later can attach to it
+TABLE_ENV = 'HOME_STATE_TABLE'
+# Number of slots, size of each slot, and the name of the table that replaced this one, if any
+TABLE_HEADER = struct.Struct('<II56s')
+# Device UUID, sequence number (odd while the slot is being written), time of the last write, and payload length
+SLOT_HEADER = struct.Struct('<16sQdI')
+EMPTY = bytes(16)
+
+
+class StateTable:
+    """
+    Fixed-size slots, each holding one device's published values as JSON, found by hashing the device's UUID. Each
+    value is kept under its own key, e.g. 'state' for what `get_state` answers, so a driver publishing something else
+    doesn't replace its state. Only the process that creates the table assigns slots; others only look them up, so
+    slots never move while they are being read.
+
+    A device's state may be published by several threads and processes at once, e.g. the poller and a worker, so
+    writers take a lock on the slot: a lock on the matching byte of a lock file across processes, where the platform
+    supports it, and the table's lock between threads.
+    """
+
+    def __init__(self, memory, slots: int, slot_size: int):
+        self.memory = memory
+        self.buf = memory.buf
+        self.slots = slots
+        self.slot_size = slot_size
+        self.used = 0
+        self.offsets = {}
+        self.lock = Lock()
+        self.lock_file = None
+
+    @classmethod
+    def create(cls, uuids: Iterable[str], slot_size: int = STATE_SLOT_SIZE) -> 'StateTable':
+        uuids = list(uuids)
+        # Keep the table at most half full, so lookups stay short
+        slots = max(16, len(uuids) * 2)
+        memory = shared_memory.SharedMemory(create=True, size=TABLE_HEADER.size + slots * slot_size)
+        TABLE_HEADER.pack_into(memory.buf, 0, slots, slot_size, b'')
+        table = cls(memory, slots, slot_size)
+        table.assign(uuids)
+        return table
+
+    @classmethod
+    def attach(cls, name: str) -> 'StateTable':
+        memory = shared_memory.SharedMemory(name=name)
+        slots, slot_size, _ = TABLE_HEADER.unpack_from(memory.buf, 0)
+        return cls(memory, slots, slot_size)
+
+    @property
+    def name(self) -> str:
+        return self.memory.name
+
+    @property
+    def successor(self) -> Optional[str]:
+        """
+        The name of the table that replaced this one after the config changed.
+        """
+        return TABLE_HEADER.unpack_from(self.buf, 0)[2].rstrip(b'\0').decode() or None
+
+    @successor.setter
+    def successor(self, name: str) -> None:
+        TABLE_HEADER.pack_into(self.buf, 0, self.slots, self.slot_size, name.encode())
+
+    @property
+    def lock_path(self) -> str:
+        return os.path.join(tempfile.gettempdir(), self.name.lstrip('/') + '.lock')
+
+    def assign(self, uuids: Iterable[str]) -> bool:
+        """
+        Give each device a slot, unless it has one already.
+        :return: False if the table would be more than half full, in which case nothing is assigned
+        """
+        new = [uuid for uuid in uuids if self._find(uuid) is None]
+        if self.used + len(new) > self.slots // 2:
+            return False
+        for uuid in new:
+            key = UUID(uuid).bytes
+            for offset, stored in self._probe(key):
+                if stored == EMPTY:
+                    self.buf[offset:offset + len(key)] = key
+                    self.used += 1
+                    break
+        return True
+
+    def publish(self, uuid: str, key: str, value: Any, updated: float = None) -> bool:
+        """
+        Store one of a device's values, keeping its others.
+        :param updated: When the value was published, if not now
+        :return: False if the device has no slot
+        :raises ValueError: The device's values are too large for a slot
+        """
+        offset = self._find(uuid)
+        if offset is None:
+            return False
+        with self._write_lock(offset):
+            entries = self._entries(offset) or {}
+            entries[key] = [value, updated or time()]
+            payload = json.dumps(entries, default=str).encode()
+            if len(payload) > self.slot_size - SLOT_HEADER.size:
+                raise ValueError("State of {} bytes is too large for a {} byte slot".format(len(payload),
+                                                                                            self.slot_size))
+            device_key, sequence, _, _ = SLOT_HEADER.unpack_from(self.buf, offset)
+            # Readers retry while the sequence number is odd, or if it changed while they were reading
+            SLOT_HEADER.pack_into(self.buf, offset, device_key, sequence | 1, 0, 0)
+            start = offset + SLOT_HEADER.size
+            self.buf[start:start + len(payload)] = payload
+            SLOT_HEADER.pack_into(self.buf, offset, device_key, (sequence | 1) + 1, time(), len(payload))
+        return True
+
+    def read(self, uuid: str, key: str = 'state') -> Optional[Tuple[Any, float]]:
+        """
+        :return: One of a device's values and when it was published, or None if it hasn't been
+        """
+        entry = self.entries(uuid).get(key)
+        return tuple(entry) if entry else None
+
+    def entries(self, uuid: str) -> Dict[str, list]:
+        """
+        :return: Each of a device's published values and when it was published, by key
+        """
+        offset = self._find(uuid)
+        return (self._entries(offset) if offset is not None else None) or {}
+
+    def _entries(self, offset: int) -> Optional[Dict[str, list]]:
+        for _ in range(100):
+            _, sequence, updated, length = SLOT_HEADER.unpack_from(self.buf, offset)
+            if sequence % 2:
+                continue
+            start = offset + SLOT_HEADER.size
+            payload = bytes(self.buf[start:start + length])
+            if SLOT_HEADER.unpack_from(self.buf, offset)[1] != sequence:
+                continue
+            if not length:
+                return None
+            try:
+                return json.loads(payload)
+            except ValueError:
+                # Torn by a writer that doesn't take the slot's lock, e.g. on a platform without file locks
+                continue
+        return None
+
+    @contextmanager
+    def _write_lock(self, offset: int):
+        with self.lock:
+            if fcntl is None:
+                yield
+                return
+            if self.lock_file is None:
+                self.lock_file = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+            slot = (offset - TABLE_HEADER.size) // self.slot_size
+            fcntl.lockf(self.lock_file, fcntl.LOCK_EX, 1, slot)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.lock_file, fcntl.LOCK_UN, 1, slot)
+
+    def close(self) -> None:
+        if self.lock_file is not None:
+            os.close(self.lock_file)
+            self.lock_file = None
+        self.memory.close()
+
+    def _find(self, uuid: str) -> Optional[int]:
+        if uuid not in self.offsets:
+            key = UUID(uuid).bytes
+            for offset, stored in self._probe(key):
+                if stored == key:
+                    self.offsets[uuid] = offset
+                    break
+                elif stored == EMPTY:
+                    return None
+        return self.offsets.get(uuid)
+
+    def _probe(self, key: bytes) -> Iterator[Tuple[int, bytes]]:
+        start = int.from_bytes(key[:8], 'little') % self.slots
+        for i in range(self.slots):
+            offset = TABLE_HEADER.size + (start + i) % self.slots * self.slot_size
+            yield offset, bytes(self.buf[offset:offset + len(key)])
+
+
+table = None
+# Tables this process created, removed when it exits
+created = []
+lock = Lock()
+
+
+def get_table() -> Optional[StateTable]:
+    """
+    The current state table, attached to on first use in worker processes. None if shared memory isn't available or
+    no config has been loaded.
+    """
+    global table
+    with lock:
+        if table is None and shared_memory is not None and os.environ.get(TABLE_ENV):
+            try:
+                table = StateTable.attach(os.environ[TABLE_ENV])
+            except FileNotFoundError:
+                return None
+        while table is not None and table.successor:
+            try:
+                table = StateTable.attach(table.successor)
+            except FileNotFoundError:
+                break
+        return table
+
+
+def refresh(uuids: Iterable[str]) -> None:
+    """
+    Give every configured device a slot once a config is loaded, replacing the table if it is too full. States of
+    devices that are still configured are carried over.
+    """
+    global table
+    if shared_memory is None:
+        return
+    uuids = list(uuids)
+    with lock:
+        if table is not None and table in created and table.assign(uuids):
+            return
+        new = StateTable.create(uuids)
+        if table is not None:
+            for uuid in uuids:
+                for key, (value, updated) in table.entries(uuid).items():
+                    new.publish(uuid, key, value, updated)
+            table.successor = new.name
+        created.append(new)
+        # Keep the previous table around so processes still using it can find its successor
+        while len(created) > 2:
+            retire(created.pop(0))
+        table = new
+        os.environ[TABLE_ENV] = new.name
+
+
+def retire(old: StateTable) -> None:
+    old.close()
+    old.memory.unlink()
+    try:
+        os.remove(old.lock_path)
+    except FileNotFoundError:
+        pass
+
+
+@atexit.register
+def close() -> None:
+    while created:
+        retire(created.pop())
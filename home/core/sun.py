@@ -0,0 +1,121 @@
+"""
+sun.py
+~~~~~~
+
+Sun events for the configured location, the brightness of sunlight through the day, and a scheduler trigger that
+fires at sun events.
+"""
+from array import array
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from typing import Dict, Optional
+
+from apscheduler.triggers.base import BaseTrigger
+from astral import Astral, AstralError
+
+from home import settings
+
+SUN_EVENTS = ('dawn', 'sunrise', 'noon', 'sunset', 'dusk')
+
+
+@lru_cache(maxsize=1)
+def get_city():
+    a = Astral()
+    a.solar_depression = settings.SOLAR_DEPRESSION
+    return a[settings.LOCATION]
+
+
+@lru_cache(maxsize=8)
+def sun_events(day: date) -> Dict[str, datetime]:
+    """
+    :return: Local times of dawn, sunrise, noon, sunset and dusk on the given day
+    :raises AstralError: The sun doesn't reach one of them on that day
+    """
+    return get_city().sun(date=day, local=True)
+
+
+def today() -> date:
+    return datetime.now(get_city().tz).date()
+
+
+def minute_of_day(dt: datetime) -> float:
+    return dt.hour * 60 + dt.minute + dt.second / 60
+
+
+@lru_cache(maxsize=2)
+def sunlight_table(day: date) -> array:
+    """
+    White level for each minute of a day: full between sunrise and sunset, and dimming by 200 over six hours before
+    sunrise and after sunset.
+    """
+    try:
+        events = sun_events(day)
+    except AstralError:
+        return array('B', [255]) * 1440
+    sunrise = minute_of_day(events['sunrise'])
+    sunset = minute_of_day(events['sunset'])
+    table = array('B', bytes(1440))
+    for minute in range(1440):
+        if minute < sunrise:
+            white = 255 - (sunrise - minute) / 60 * 200 / 6
+        elif minute > sunset:
+            white = 255 - (minute - sunset) / 60 * 200 / 6
+        else:
+            white = 255
+        table[minute] = max(0, min(255, round(white)))
+    return table
+
+
+def sunlight(now: datetime = None) -> Dict[str, int]:
+    """
+    The color for a bulb to match the current sunlight, red late at night.
+    """
+    now = now or datetime.now(get_city().tz)
+    if now.hour < 4 or now.hour >= 22:
+        return {'red': 255}
+    return {'white': sunlight_table(now.date())[now.hour * 60 + now.minute]}
+
+
+class SunTrigger(BaseTrigger):
+    """
+    Fires at a sun event each day, e.g. 30 minutes before sunset. The event's time is only computed once a day, when
+    the previous run is done.
+    :param event: One of dawn, sunrise, noon, sunset or dusk
+    :param offset: Seconds after the event to fire, or before it if negative
+    :param jitter: Up to how many seconds to delay each run by, at random
+    """
+
+    def __init__(self, event: str = 'sunset', offset: int = 0, jitter: int = None):
+        if event not in SUN_EVENTS:
+            raise ValueError("Unknown sun event '{}', expected one of {}".format(event, ', '.join(SUN_EVENTS)))
+        self.event = event
+        self.offset = offset
+        self.jitter = jitter
+
+    def get_next_fire_time(self, previous_fire_time: Optional[datetime], now: datetime) -> Optional[datetime]:
+        start = previous_fire_time or now
+        day = start.astimezone(get_city().tz).date() - timedelta(days=1)
+        # Near the poles, the sun may not rise or set for months
+        for _ in range(367):
+            try:
+                fire_time = sun_events(day)[self.event] + timedelta(seconds=self.offset)
+            except AstralError:
+                fire_time = None
+            if fire_time and (fire_time > start if previous_fire_time else fire_time >= start):
+                return self._apply_jitter(fire_time, self.jitter, now)
+            day += timedelta(days=1)
+        return None
+
+    def __getstate__(self):
+        return {'version': 1, 'event': self.event, 'offset': self.offset, 'jitter': self.jitter}
+
+    def __setstate__(self, state):
+        self.event = state['event']
+        self.offset = state['offset']
+        self.jitter = state.get('jitter')
+
+    def __str__(self):
+        return 'sun[{}{:+d}s]'.format(self.event, self.offset)
+
+    def __repr__(self):
+        return "<{} (event='{}', offset={})>".format(self.__class__.__name__, self.event, self.offset)
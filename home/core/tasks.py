@@ -5,16 +5,26 @@ tasks.py
 Handles running of tasks in an asynchronous fashion. Not explicitly tied to Celery. The `run` method simply must
 exist here and handle the execution of whatever task is passed to it, whether or not it is handled asynchronously.
 """
+import asyncio
+import logging
+import os
+from collections import deque
+from concurrent.futures import Future, CancelledError, TimeoutError
 from concurrent.futures.process import ProcessPoolExecutor
 from concurrent.futures.thread import ThreadPoolExecutor
-from time import sleep
-from typing import Callable
+from functools import partial
+from heapq import heappush, heappop
+from itertools import count
+from threading import Event, Lock, Condition, Thread, local
+from time import monotonic, time
+from typing import Callable, Dict, List, Optional
+from uuid import uuid4
 
 from apscheduler.schedulers.background import BackgroundScheduler
-from celery import Celery
-from celery.utils.log import get_task_logger
 
-from home.settings import ASYNC_MODE, SENTRY_URL, BROKER_PATH, BACKEND_PATH, MAX_THREADS, MAX_PROCESSES
+from home.core.jobstore import BoundedMemoryJobStore, SQLiteJobStore
+from home.settings import ASYNC_MODE, SENTRY_URL, BROKER_PATH, BACKEND_PATH, MAX_THREADS, MAX_PROCESSES, \
+    TASK_HISTORY, JOB_STORE, JOB_MISFIRE_GRACE, SYNC_TIMEOUT
 try:
     from sentry_sdk import init
 
@@ -23,34 +33,55 @@ try:
 except ImportError:
     pass
 
-queue = Celery('home',
-               broker=BROKER_PATH,
-               backend=BACKEND_PATH,
-               )
-
-queue.conf.update(
-    CELERY_TASK_SOFT_TIME_LIMIT=30,
-)
-
+job_store = SQLiteJobStore(JOB_STORE) if JOB_STORE else BoundedMemoryJobStore()
+scheduler_options = dict(jobstores={'default': job_store},
+                         job_defaults={'misfire_grace_time': JOB_MISFIRE_GRACE, 'coalesce': True})
 try:
     import gevent
 
     from apscheduler.schedulers.gevent import GeventScheduler
 
-    scheduler = GeventScheduler()
+    scheduler = GeventScheduler(**scheduler_options)
     thread_runner = gevent.spawn
 except ImportError:
-    scheduler = BackgroundScheduler()
-    executor = ThreadPoolExecutor(max_workers=MAX_THREADS)
-    thread_runner = executor.submit
-scheduler.start()
-logger = get_task_logger(__name__)
+    scheduler = BackgroundScheduler(**scheduler_options)
+    executor = thread_pool = ThreadPoolExecutor(max_workers=MAX_THREADS)
+
+    def thread_runner(fn: Callable, *args, **kwargs) -> Future:
+        return thread_pool.submit(fn, *args, **kwargs)
+
+    def reset_thread_pool() -> None:
+        """
+        A forked process gets a pool of its own, since the parent's threads don't exist there and its copy of the
+        pool would never run anything.
+        """
+        global executor, thread_pool
+        if executor is thread_pool:
+            executor = thread_pool = ThreadPoolExecutor(max_workers=MAX_THREADS)
+        else:
+            thread_pool = ThreadPoolExecutor(max_workers=MAX_THREADS)
+
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=reset_thread_pool)
+# Cron jobs only run once the config's jobs are in sync with the store, so stored jobs that were removed from the
+#  config don't run at startup
+scheduler.start(paused=True)
+logger = logging.getLogger(__name__)
 
 if ASYNC_MODE == 'multiprocessing':
     executor = ProcessPoolExecutor(max_workers=MAX_PROCESSES)
 
 
-@queue.task
+celery_app = None
+celery_run = None
+celery_lock = Lock()
+process_pool = None
+loop = None
+pool_lock = Lock()
+# Ways a task may be run, which drivers may choose between in the config
+EXECUTORS = ('inline', 'thread', 'process', 'worker', 'asyncio', 'celery')
+
+
 def _run(method, **kwargs) -> None:
     """
     Run the configured actions in multiple processes.
@@ -62,22 +93,663 @@ def _run(method, **kwargs) -> None:
     method(**kwargs)
 
 
-def run(method: Callable, delay: float = 0, thread: bool = False, **kwargs):
-    if ASYNC_MODE == 'celery':
-        return _run.apply_async(args=[method], kwargs=kwargs, countdown=float(delay))
-    elif thread:
-        return thread_run(method, delay, **kwargs)
-    else:
-        return multiprocessing_run(method, delay, **kwargs)
+def get_queue():
+    """
+    Create the Celery app on first use, since importing Celery is slow and only needed in Celery mode.
+    """
+    global celery_app, celery_run
+    with celery_lock:
+        if celery_app is None:
+            from celery import Celery
 
+            app = Celery('home',
+                         broker=BROKER_PATH,
+                         backend=BACKEND_PATH,
+                         )
+            app.conf.update(
+                CELERY_TASK_SOFT_TIME_LIMIT=30,
+            )
+            celery_run = app.task(_run)
+            celery_app = app
+    return celery_app
 
-def thread_run(target: Callable, delay: float = 0, **kwargs):
-    if delay:
-        sleep(delay)
-    return thread_runner(target, **kwargs)
+
+def __getattr__(name: str):
+    # Keeps `celery -A home.core.tasks.queue` working
+    if name == 'queue':
+        return get_queue()
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """
+    The shared process pool, which is only created when something needs it unless ASYNC_MODE is 'multiprocessing'.
+    """
+    global process_pool
+    if ASYNC_MODE == 'multiprocessing':
+        return executor
+    with pool_lock:
+        if process_pool is None:
+            process_pool = ProcessPoolExecutor(max_workers=MAX_PROCESSES)
+    return process_pool
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """
+    The shared event loop, started on its own thread when first needed.
+    """
+    global loop
+    with pool_lock:
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            Thread(target=loop.run_forever, name='asyncio', daemon=True).start()
+    return loop
+
+
+def inline_submit(target: Callable, **kwargs) -> Future:
+    """
+    Run a task in the calling thread, for methods too quick to be worth handing to a pool.
+    """
+    future = Future()
+    if future.set_running_or_notify_cancel():
+        try:
+            future.set_result(target(**kwargs))
+        except Exception as e:
+            future.set_exception(e)
+    return future
+
+
+def handoff(submit: Callable) -> Callable:
+    """
+    Inline tasks that were delayed or queued run on a thread instead, so a slow device can't hold up the timer or
+    whichever task finished before them.
+    """
+    if isinstance(submit, Cancellable):
+        return Cancellable(handoff(submit.submit), submit.stop)
+    return thread_runner if submit is inline_submit else submit
+
+
+# The stop event of the task running in each thread, if it can be cancelled while it runs
+current = local()
 
 
-def multiprocessing_run(target: Callable, delay: float = 0, **kwargs):
+def cancel_requested() -> bool:
+    """
+    Long-running device methods check this every so often, e.g. once a frame, and return early once it is True.
+    :return: Whether the task calling this was cancelled while it was running
+    """
+    stop = getattr(current, 'stop', None)
+    return stop is not None and stop.is_set()
+
+
+class Cancellable:
+    """
+    Submits a task in this process along with an event that is set when it is cancelled while running, which the
+    task sees through `cancel_requested`.
+    """
+
+    def __init__(self, submit: Callable, stop: Event):
+        self.submit = submit
+        self.stop = stop
+
+    def __call__(self, target: Callable, **kwargs):
+        return self.submit(partial(self._run, target), **kwargs)
+
+    def _run(self, target: Callable, **kwargs):
+        previous = getattr(current, 'stop', None)
+        current.stop = self.stop
+        try:
+            return target(**kwargs)
+        finally:
+            current.stop = previous
+
+
+def process_submit(target: Callable, **kwargs) -> Future:
+    return get_process_pool().submit(target, **kwargs)
+
+
+def worker_submit(target: Callable, **kwargs) -> Future:
+    """
+    Run a device method in a worker process that keeps its own copy of the devices.
+    """
+    from home.core.workers import worker_pool
+
+    return worker_pool.submit(target, **kwargs)
+
+
+def async_variant(method: Callable) -> Optional[Callable]:
+    """
+    Drivers may implement a method as a coroutine too, named with an `async_` prefix, e.g. `async_change_color`.
+    :return: The coroutine version of a driver method, if it has one
+    """
+    variant = getattr(getattr(method, '__self__', None), 'async_' + getattr(method, '__name__', ''), None)
+    return variant if asyncio.iscoroutinefunction(variant) else None
+
+
+def call(method: Callable, timeout: float = None, **kwargs):
+    """
+    Call a driver method and wait for its result, awaiting its coroutine version on the shared loop if it has one.
+    :raises TimeoutError: The coroutine took longer than `timeout`, and was cancelled
+    """
+    variant = async_variant(method)
+    if variant is None:
+        return method(**kwargs)
+    future = asyncio.run_coroutine_threadsafe(variant(**kwargs), get_loop())
+    try:
+        return future.result(timeout)
+    except TimeoutError:
+        # Stop the coroutine rather than leave it running with nobody waiting for it
+        future.cancel()
+        raise
+
+
+def asyncio_submit(target: Callable, **kwargs) -> Future:
+    """
+    Run a task on the shared event loop. Coroutine functions, and methods with a coroutine version, are awaited
+    there; other functions are called on the loop's thread, so they should not block.
+    """
+    coroutine = target if asyncio.iscoroutinefunction(target) else async_variant(target)
+    if coroutine is not None:
+        return asyncio.run_coroutine_threadsafe(coroutine(**kwargs), get_loop())
+    future = Future()
+
+    def call():
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(target(**kwargs))
+            except Exception as e:
+                future.set_exception(e)
+
+    get_loop().call_soon_threadsafe(call)
+    return future
+
+
+def run(method: Callable, delay: float = 0, thread: bool = False, device: str = None, origin: str = None,
+        executor: str = None, sync: 'SyncGroup' = None, **kwargs) -> 'TrackedTask':
+    """
+    :param device: Name of the device the method belongs to. Tasks for the same device run one at a time, in the
+    order they were submitted
+    :param origin: What submitted the task, e.g. a user or action, shown when listing tasks
+    :param executor: One of `EXECUTORS` to run the task with, instead of the default for ASYNC_MODE. Methods with a
+    coroutine version run on the shared event loop by default
+    :param sync: Group of tasks for other devices to release this task together with. Celery tasks leave the group
+    """
+    if executor is None and async_variant(method):
+        executor = 'asyncio'
+    elif executor is None:
+        executor = 'celery' if ASYNC_MODE == 'celery' else 'thread' if thread else \
+            'worker' if ASYNC_MODE == 'workers' else None
+    if executor == 'celery':
+        get_queue()
+        if sync is not None:
+            sync.leave()
+        return task_registry.track(celery_run.apply_async(args=[method], kwargs=kwargs, countdown=float(delay)),
+                                   method, device, origin)
+    elif executor is None:
+        return multiprocessing_run(method, delay, device, origin, sync, **kwargs)
+    return dispatch(SUBMITTERS[executor], method, delay, device, origin, sync, **kwargs)
+
+
+def thread_run(target: Callable, delay: float = 0, device: str = None, origin: str = None,
+               sync: 'SyncGroup' = None, **kwargs) -> 'TrackedTask':
+    return dispatch(thread_runner, target, delay, device, origin, sync, **kwargs)
+
+
+def multiprocessing_run(target: Callable, delay: float = 0, device: str = None, origin: str = None,
+                        sync: 'SyncGroup' = None, **kwargs) -> 'TrackedTask':
+    return dispatch(executor.submit, target, delay, device, origin, sync, **kwargs)
+
+
+def dispatch(submit: Callable, target: Callable, delay: float = 0, device: str = None, origin: str = None,
+             sync: 'SyncGroup' = None, **kwargs) -> 'TrackedTask':
+    """
+    Submit a task with `submit`, after its delay and behind the device's other tasks, and track it.
+    """
+    stop = None
+    if submit is inline_submit or submit is thread_runner:
+        stop = Event()
+        submit = Cancellable(submit, stop)
+    if delay:
+        submit = handoff(submit)
+    if sync is not None:
+        # Devices run in other processes are prepared there, when they are called
+        local = submit not in (process_submit, worker_submit) and \
+            not isinstance(getattr(submit, '__self__', None), ProcessPoolExecutor)
+        submit = sync.submitter(submit, getattr(getattr(target, '__self__', None), 'prepare', None) if local else None)
+    if device is not None:
+        submit = device_queues.submitter(device, submit)
     if delay:
-        sleep(delay)
-    return executor.submit(target, **kwargs)
+        return task_registry.track(timer.submit_later(delay, submit, target, **kwargs), target, device, origin, stop)
+    return task_registry.track(submit(target, **kwargs), target, device, origin, stop)
+
+
+SUBMITTERS = {
+    'inline': inline_submit,
+    'thread': thread_runner,
+    'process': process_submit,
+    'worker': worker_submit,
+    'asyncio': asyncio_submit,
+}
+
+
+def chain(task, future: Future) -> None:
+    """
+    Complete a future with the outcome of a task, which is either a future or a greenlet.
+    """
+    if hasattr(task, 'add_done_callback'):
+        def done(t):
+            if t.cancelled():
+                future.set_exception(CancelledError())
+            elif t.exception() is not None:
+                future.set_exception(t.exception())
+            else:
+                future.set_result(t.result())
+
+        task.add_done_callback(done)
+    elif hasattr(task, 'link'):
+        def done(g):
+            if g.successful():
+                future.set_result(g.value)
+            else:
+                future.set_exception(g.exception)
+
+        task.link(done)
+    else:
+        future.set_result(task)
+
+
+class Timer:
+    """
+    Calls functions at a due time from a single background thread, kept in a heap ordered by due time, so callers
+    never have to sleep until a delayed task is due. A forked process starts with an empty timer of its own, since
+    the parent's thread doesn't exist there.
+    """
+
+    def __init__(self):
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self) -> None:
+        self.queue = []
+        self.counter = count()
+        self.condition = Condition()
+        self.thread = None
+
+    def call_later(self, delay: float, func: Callable, *args, **kwargs) -> None:
+        with self.condition:
+            heappush(self.queue, (monotonic() + delay, next(self.counter), func, args, kwargs))
+            if self.thread is None:
+                self.thread = Thread(target=self._loop, name='timer', daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def submit_later(self, delay: float, submit: Callable, target: Callable, **kwargs) -> Future:
+        """
+        Submit a task once its delay has passed.
+        :return: A future for the task's result, which may be cancelled until the task is submitted
+        """
+        future = Future()
+
+        def fire():
+            if future.set_running_or_notify_cancel():
+                try:
+                    chain(submit(target, **kwargs), future)
+                except Exception as e:
+                    future.set_exception(e)
+
+        self.call_later(delay, fire)
+        return future
+
+    def _loop(self) -> None:
+        while True:
+            with self.condition:
+                while not self.queue or self.queue[0][0] > monotonic():
+                    self.condition.wait(self.queue[0][0] - monotonic() if self.queue else None)
+                _, _, func, args, kwargs = heappop(self.queue)
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                logger.exception("Error running delayed task {}".format(func))
+
+
+class DeviceQueues:
+    """
+    Runs tasks for each device one at a time, in submission order, on top of a shared pool. Tasks for different
+    devices still run in parallel. A device only has a queue while it has a task running.
+
+    Methods listed in `coalesced` for a device are latest-wins: a new call replaces one still waiting in the queue,
+    so only the newest state is sent once the device is free.
+    """
+
+    def __init__(self):
+        self.queues = {}
+        self.coalesced = {}
+        self.lock = Lock()
+
+    def submitter(self, device: str, submit: Callable) -> Callable:
+        """
+        :return: A function like `submit` that queues its task behind the device's other tasks
+        """
+        return lambda target, **kwargs: self.submit(device, submit, target, **kwargs)
+
+    def submit(self, device: str, submit: Callable, target: Callable, **kwargs) -> Future:
+        """
+        Submit a task with `submit` once the device's earlier tasks are done.
+        :return: A future for the task's result, which may be cancelled while the task is queued, and is cancelled
+        if a newer call to a coalesced method replaces it
+        """
+        future = Future()
+        replaced = []
+        with self.lock:
+            queue = self.queues.get(device)
+            if queue is not None:
+                if getattr(target, '__name__', None) in self.coalesced.get(device, ()):
+                    replaced = [task for task in queue if task[1] == target]
+                    for task in replaced:
+                        queue.remove(task)
+                queue.append((handoff(submit), target, kwargs, future))
+            else:
+                self.queues[device] = deque()
+        for task in replaced:
+            task[3].cancel()
+        if queue is None:
+            self._start(device, submit, target, kwargs, future)
+        return future
+
+    def _start(self, device: str, submit: Callable, target: Callable, kwargs: Dict, future: Future) -> None:
+        while True:
+            if future.set_running_or_notify_cancel():
+                try:
+                    chain(submit(target, **kwargs), future)
+                except Exception as e:
+                    future.set_exception(e)
+                if not future.done():
+                    future.add_done_callback(lambda _: self._next(device))
+                    return
+            # The task was cancelled or already finished, so move straight on to the next one
+            task = self._pop(device)
+            if task is None:
+                return
+            submit, target, kwargs, future = task
+
+    def _next(self, device: str) -> None:
+        task = self._pop(device)
+        if task is not None:
+            self._start(device, *task)
+
+    def _pop(self, device: str):
+        with self.lock:
+            if self.queues[device]:
+                return self.queues[device].popleft()
+            del self.queues[device]
+
+    def depth(self) -> Dict[str, int]:
+        """
+        :return: Number of tasks running or waiting, by device
+        """
+        with self.lock:
+            return {device: len(queue) + 1 for device, queue in self.queues.items()}
+
+
+class SyncGroup:
+    """
+    Releases tasks for several devices together, within a few milliseconds of each other. Each task waits until its
+    turn in its device's queue has come and its device has run its optional `prepare` hook, e.g. to open its
+    connection. Once every task is ready, or SYNC_TIMEOUT after the first one was, the ready tasks are submitted at
+    once; any later ones go ahead as soon as they are ready.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.ready = []
+        self.released = False
+        self.lock = Lock()
+
+    def submitter(self, submit: Callable, prepare: Callable = None) -> Callable:
+        """
+        :return: A function like `submit` that holds its task until the group is released
+        """
+        return lambda target, **kwargs: self.submit(submit, prepare, target, **kwargs)
+
+    def submit(self, submit: Callable, prepare: Optional[Callable], target: Callable, **kwargs) -> Future:
+        future = Future()
+
+        def ready():
+            if prepare is not None:
+                try:
+                    prepare()
+                except Exception as e:
+                    logger.warning("Couldn't prepare {}: {}".format(prepare.__self__, e))
+            with self.lock:
+                late = self.released
+                if not late:
+                    self.ready.append((submit, target, kwargs, future))
+                    if len(self.ready) == 1:
+                        timer.call_later(SYNC_TIMEOUT, self.release)
+                    complete = len(self.ready) >= self.size
+            if late:
+                # A device took too long to get ready; the rest went ahead without it
+                self._start(submit, target, kwargs, future)
+            elif complete:
+                self.release()
+
+        if prepare is not None:
+            thread_runner(ready)
+        else:
+            ready()
+        return future
+
+    def leave(self) -> None:
+        """
+        Stop waiting for a task that won't be submitted through the group.
+        """
+        with self.lock:
+            self.size -= 1
+            complete = self.ready and len(self.ready) >= self.size
+        if complete:
+            self.release()
+
+    def release(self) -> None:
+        with self.lock:
+            if self.released:
+                return
+            self.released = True
+            ready, self.ready = self.ready, []
+        for task in ready:
+            self._start(*task)
+
+    @staticmethod
+    def _start(submit: Callable, target: Callable, kwargs: Dict, future: Future) -> None:
+        if future.set_running_or_notify_cancel():
+            try:
+                chain(handoff(submit)(target, **kwargs), future)
+            except Exception as e:
+                future.set_exception(e)
+
+
+class TrackedTask:
+    """
+    A submitted task, which may be a future, a greenlet or a Celery result, along with where it came from.
+    """
+    FINISHED = ('done', 'failed', 'cancelled')
+
+    def __init__(self, task, method: Callable, device: str = None, origin: str = None, stop: Event = None):
+        self.id = uuid4().hex
+        self.task = task
+        self.method = getattr(method, '__name__', str(method))
+        self.device = device
+        self.origin = origin
+        self.started = time()
+        # Set to ask the task to stop while it runs, for tasks running in this process
+        self.stop = stop
+
+    @property
+    def state(self) -> str:
+        """
+        One of 'pending', 'running', 'done', 'failed' or 'cancelled'. Queued and delayed tasks are pending.
+        """
+        task = self.task
+        if isinstance(task, Future):
+            if task.cancelled() or task.done() and self.stop is not None and self.stop.is_set():
+                return 'cancelled'
+            elif task.done():
+                return 'failed' if task.exception() is not None else 'done'
+            return 'running' if task.running() else 'pending'
+        elif hasattr(task, 'link'):
+            if not task.ready():
+                return 'running'
+            return 'done' if task.successful() else 'failed'
+        elif hasattr(task, 'revoke'):
+            return {'PENDING': 'pending', 'RECEIVED': 'pending', 'STARTED': 'running', 'RETRY': 'running',
+                    'SUCCESS': 'done', 'REVOKED': 'cancelled'}.get(task.state, 'failed')
+        return 'done'
+
+    def cancel(self) -> bool:
+        """
+        Cancel the task if it hasn't started. Greenlets and Celery tasks are stopped even if they are running, and
+        running tasks in this process are asked to stop, which long-running methods check with `cancel_requested`.
+        :return: Whether the task was cancelled, or asked to stop
+        """
+        task = self.task
+        if isinstance(task, Future):
+            if task.cancel():
+                return True
+            elif self.stop is not None and not task.done():
+                self.stop.set()
+                return True
+            return False
+        elif hasattr(task, 'kill'):
+            if task.ready():
+                return False
+            task.kill(block=False)
+            return True
+        elif hasattr(task, 'revoke'):
+            task.revoke(terminate=True)
+            return True
+        return False
+
+    def outcome(self):
+        """
+        :return: The finished task's result, or the exception it raised
+        """
+        task = self.task
+        if isinstance(task, Future):
+            return task.exception() or task.result()
+        elif hasattr(task, 'link'):
+            return task.value if task.successful() else task.exception
+        return task.result
+
+    def result(self, timeout: float = None):
+        """
+        Wait for the task to finish.
+        :return: The task's result
+        :raises: The exception the task raised
+        """
+        task = self.task
+        if isinstance(task, Future):
+            return task.result(timeout)
+        return task.get(timeout=timeout)
+
+    def add_done_callback(self, fn: Callable[['TrackedTask'], None]) -> bool:
+        """
+        Call `fn` with this task once it finishes. Celery results can't notify us, so this is ignored for them.
+        :return: Whether `fn` will be called
+        """
+        if isinstance(self.task, Future):
+            self.task.add_done_callback(lambda _: fn(self))
+        elif hasattr(self.task, 'link'):
+            self.task.link(lambda _: fn(self))
+        else:
+            return False
+        return True
+
+    def as_dict(self) -> Dict:
+        return {'id': self.id, 'device': self.device, 'method': self.method, 'origin': self.origin,
+                'started': self.started, 'state': self.state}
+
+
+class TaskRegistry:
+    """
+    Keeps every submitted task until it finishes, plus the most recently finished ones. Tasks are moved to the
+    history as they finish, except Celery results, which can't tell us. Every Celery result is checked when tasks are
+    listed, and the oldest one whenever a task is submitted, so they don't pile up if nobody lists them.
+    """
+
+    def __init__(self, history: int = 100):
+        self.tasks = {}
+        self.finished = deque(maxlen=history)
+        # Celery results not known to have finished, oldest first
+        self.celery = deque()
+        self.history = history
+        self.lock = Lock()
+
+    def track(self, task, method: Callable, device: str = None, origin: str = None,
+              stop: Event = None) -> TrackedTask:
+        tracked = TrackedTask(task, method, device, origin, stop)
+        with self.lock:
+            self.tasks[tracked.id] = tracked
+        if not tracked.add_done_callback(self._finish) and hasattr(task, 'revoke'):
+            self._prune_celery()
+            with self.lock:
+                self.celery.append(tracked)
+        return tracked
+
+    def _prune_celery(self) -> None:
+        """
+        Look up the oldest Celery result, a round trip to the result backend, and retire it if it finished. Results
+        that never report finishing, e.g. because the backend lost them, are dropped past ten times the history.
+        """
+        with self.lock:
+            oldest = self.celery[0] if self.celery else None
+            while len(self.celery) > max(self.history, 1) * 10:
+                self.tasks.pop(self.celery.popleft().id, None)
+        if oldest is not None and oldest.state in TrackedTask.FINISHED:
+            with self.lock:
+                if self.celery and self.celery[0] is oldest:
+                    self.celery.popleft()
+            self._finish(oldest)
+
+    def _finish(self, tracked: TrackedTask) -> None:
+        with self.lock:
+            if self.tasks.pop(tracked.id, None) is not None:
+                self.finished.append(tracked)
+
+    def get(self, task_id: str) -> TrackedTask:
+        """
+        :raises KeyError: No such task is known
+        """
+        with self.lock:
+            if task_id in self.tasks:
+                return self.tasks[task_id]
+            for tracked in self.finished:
+                if tracked.id == task_id:
+                    return tracked
+        raise KeyError(task_id)
+
+    def list(self) -> List[TrackedTask]:
+        with self.lock:
+            unfinished = list(self.celery)
+        # Asking Celery for a task's state is a round trip to the result backend, so all of them are only asked here
+        finished = [tracked for tracked in unfinished if tracked.state in TrackedTask.FINISHED]
+        with self.lock:
+            for tracked in finished:
+                try:
+                    self.celery.remove(tracked)
+                except ValueError:
+                    pass
+        for tracked in finished:
+            self._finish(tracked)
+        with self.lock:
+            return sorted([*self.finished, *self.tasks.values()], key=lambda t: t.started)
+
+    def cancel(self, task_id: str) -> bool:
+        try:
+            return self.get(task_id).cancel()
+        except KeyError:
+            return False
+
+
+timer = Timer()
+device_queues = DeviceQueues()
+task_registry = TaskRegistry(TASK_HISTORY)
@@ -4,15 +4,19 @@ utils.py
 
 This module contains various utilities.
 """
+import asyncio
 import hashlib
 import importlib
+import json
 import os
 import re
 import secrets
 import subprocess
-from typing import Any, List
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urljoin, urlsplit
 
-from home.core.tasks import scheduler
+# Status codes `fetch` follows the Location of
+REDIRECTS = (301, 302, 303, 307, 308)
 
 
 def to_int(*args: List[Any]) -> List[int]:
@@ -96,6 +100,61 @@ def method_from_name(klass, method_name: str):
         raise NotImplementedError()
 
 
+def fingerprint(definition: Any) -> str:
+    """
+    Compute a stable hash of a parsed config definition, used to tell whether it changed between reloads.
+    :param definition: A structure of dicts, lists and scalars as loaded from YAML.
+    :return: A hex digest of the definition.
+    """
+    encoded = json.dumps(definition, sort_keys=True, default=lambda o: getattr(o, 'fingerprint', None) or repr(o))
+    return hashlib.sha1(encoded.encode()).hexdigest()
+
+
+async def fetch(url: str, method: str = 'GET', data: bytes = None, headers: Dict[str, str] = None,
+                timeout: float = 10, max_redirects: int = 5) -> Tuple[int, Dict[str, str], bytes]:
+    """
+    Make a simple HTTP request without blocking the event loop, for drivers' coroutine methods. Redirects are
+    followed, up to `max_redirects` of them.
+    :return: The status code, response headers with lowercase names, and body
+    """
+    for _ in range(max_redirects + 1):
+        status, response_headers, body = await asyncio.wait_for(_fetch(url, method, data, headers), timeout)
+        if status not in REDIRECTS or 'location' not in response_headers:
+            break
+        url = urljoin(url, response_headers['location'])
+        # Like browsers, follow other redirects than 307 and 308 with a GET
+        if status not in (307, 308):
+            method, data = 'GET', None
+    return status, response_headers, body
+
+
+async def _fetch(url: str, method: str, data: Optional[bytes],
+                 headers: Optional[Dict[str, str]]) -> Tuple[int, Dict[str, str], bytes]:
+    url = urlsplit(url)
+    https = url.scheme == 'https'
+    port = url.port or (443 if https else 80)
+    path = (url.path or '/') + ('?' + url.query if url.query else '')
+    data = data or b''
+    host = url.hostname if url.port in (None, 443 if https else 80) else '{}:{}'.format(url.hostname, url.port)
+    request = ['{} {} HTTP/1.0'.format(method, path), 'Host: ' + host, 'Content-Length: ' + str(len(data)),
+               'Connection: close']
+    request += ['{}: {}'.format(name, value) for name, value in (headers or {}).items()]
+    reader, writer = await asyncio.open_connection(url.hostname, port, ssl=https or None)
+    try:
+        writer.write(('\r\n'.join(request) + '\r\n\r\n').encode() + data)
+        # HTTP/1.0 responses aren't chunked and end when the server closes the connection
+        response = await reader.read()
+    finally:
+        writer.close()
+    head, _, body = response.partition(b'\r\n\r\n')
+    status, *lines = head.decode('latin-1').split('\r\n')
+    response_headers = {}
+    for line in lines:
+        name, _, value = line.partition(':')
+        response_headers[name.strip().lower()] = value.strip()
+    return int(status.split()[1]), response_headers, body
+
+
 def random_string(length: int = 32) -> str:
     return secrets.token_hex(length)
 
@@ -119,11 +178,6 @@ def update():
     reload()
 
 
-def clear_scheduled_jobs():
-    for job in scheduler.get_jobs():
-        job.remove()
-
-
 def get_groups(it):
     groups = {}
     for t in it:
@@ -0,0 +1,113 @@
+"""
+workers.py
+~~~~~~~~~~
+
+A process pool whose workers each load the config once and keep their own live devices, so a call only sends the
+device's UUID, the method name and its arguments instead of pickling the device.
+"""
+import hashlib
+from concurrent.futures import Future
+from concurrent.futures.process import ProcessPoolExecutor
+from threading import Lock
+from typing import Callable, Dict
+
+from home.settings import ASYNC_MODE, MAX_PROCESSES
+
+# In a worker process, the devices it loaded, by the UUID the web process gave them
+replica = {}
+
+
+def init_worker(config: str, uuids: Dict[str, str]) -> None:
+    """
+    Load the devices run in workers from the config into a new worker process.
+    :param config: YAML config text
+    :param uuids: Device names, by the UUID of the device in the web process
+    """
+    from home.core import parser, models
+
+    parser.parse(data=config, replica=True, only=uuids.values())
+    registry = models.get_registry()
+    for uuid, name in uuids.items():
+        device = registry.devices.get(name)
+        if device:
+            # Use the web process's UUIDs, so state published here is found there
+            device.uuid = device.dev._device_uuid = uuid
+            registry.devices_by_uuid[uuid] = device
+            replica[uuid] = device
+
+
+def call(uuid: str, method: str, kwargs: Dict):
+    """
+    Run a method of a device in the worker's replica.
+    """
+    from home.core.utils import method_from_name
+
+    return method_from_name(replica[uuid].dev, method)(**kwargs)
+
+
+def uses_workers(driver) -> bool:
+    """
+    :return: Whether any of a driver's methods may run in a worker
+    """
+    if driver.executor is None and ASYNC_MODE == 'workers':
+        return True
+    return 'worker' in (driver.executor, *driver.method_executors.values())
+
+
+class WorkerPool:
+    """
+    Runs device methods in worker processes holding a replica of the devices whose drivers use workers. The workers
+    are replaced when the config changes.
+    """
+
+    def __init__(self, max_workers: int = MAX_PROCESSES):
+        self.max_workers = max_workers
+        self.pool = None
+        self.config = None
+        self.digest = None
+        self.uuids = {}
+        self.lock = Lock()
+
+    def refresh(self, config: str, registry) -> None:
+        """
+        Use a newly loaded config. Workers running the previous one finish their tasks, then exit.
+        :param config: YAML config text the registry was loaded from
+        :param registry: The registry loaded from it
+        """
+        from home.core.models import Device
+
+        devices = [device for device in registry.devices.values()
+                   if type(device) is Device and device.dev and uses_workers(device.driver)]
+        digest = hashlib.sha256(config.encode()).hexdigest()
+        with self.lock:
+            # An unchanged config keeps the same device objects, so its workers are still up to date
+            if digest == self.digest and self.uuids.keys() == {id(device.dev) for device in devices}:
+                return
+            old = self.pool
+            self.pool = None
+            self.config = config
+            self.digest = digest
+            # Keyed by the driver instance, since tasks are submitted as its bound methods
+            self.uuids = {id(device.dev): (device.dev, device.uuid, device.name) for device in devices}
+        if old:
+            old.shutdown(wait=False)
+
+    def submit(self, target: Callable, **kwargs) -> Future:
+        """
+        Run a device method in a worker. Anything else, e.g. methods of multi-devices, is pickled to the process pool.
+        """
+        from home.core.tasks import process_submit
+
+        device = self.uuids.get(id(getattr(target, '__self__', None)))
+        if device is None or device[0] is not target.__self__:
+            return process_submit(target, **kwargs)
+        with self.lock:
+            if self.pool is None:
+                uuids = {uuid: name for _, uuid, name in self.uuids.values()}
+                self.pool = ProcessPoolExecutor(max_workers=self.max_workers, initializer=init_worker,
+                                                initargs=(self.config, uuids))
+            pool = self.pool
+        return pool.submit(call, device[1], target.__name__, kwargs)
+
+
+worker_pool = WorkerPool()
@@ -3,22 +3,27 @@
 bulb.py
 ~~~~~~~
 """
+import asyncio
 import colorsys
+import os
+import select
 import socket
 from abc import abstractmethod
-from datetime import datetime
-from typing import Dict
+from concurrent.futures import CancelledError, Future
+from functools import lru_cache
+from threading import Lock, RLock
+from typing import Callable, Dict, List, Tuple
 
 import sys
-from astral import Astral
 from flask_login import current_user
 from flask_socketio import emit, disconnect
 from pyHS100 import SmartBulb
-from time import sleep
+from time import monotonic, sleep
 
-from home import settings
 from home.core import utils as utils
-from home.core.models import get_device
+from home.core.models import get_device, publish_state
+from home.core.sun import sunlight
+from home.core.tasks import run, timer, thread_runner, cancel_requested
 from home.core.utils import to_int, RGBfromhex
 from home.iot.power import Power
 from home.web.utils import ws_login_required
@@ -27,6 +32,10 @@ from home.web.web import socketio
 SUPPORTED_MODES = ['31', '41', '61']
 SUPPORTED_FUNCTIONS = list(range(25, 39))
 TAIL = '0f'
+# Custom mode programs hold up to 16 colors, and unused slots are filled with this placeholder
+CUSTOM_SLOTS = 16
+CUSTOM_EMPTY_SLOT = bytes([0x01, 0x02, 0x03, 0x00])
+CUSTOM_TRANSITIONS = {'gradual': 0x3a, 'jumping': 0x3b, 'strobe': 0x3c}
 
 seven_color_cross_fade = 0x25
 red_gradual_change = 0x26
@@ -50,6 +59,15 @@ white_strobe_flash = 0x37
 seven_color_jumping = 0x38
 
 CONTROL_PORT = 5577
+STATE_QUERY = bytes([0x81, 0x8A, 0x8B, 0x96])
+# Seconds to wait for a bulb to connect or reply
+TIMEOUT = 5
+# Seconds between keepalive queries on an otherwise quiet connection
+KEEPALIVE = 20
+# Seconds without commands after which a connection is closed
+IDLE_TIMEOUT = 300
+# Longest wait, in seconds, before trying to reach an unreachable bulb again
+MAX_BACKOFF = 30
 # The HFLPB100's control/debug module
 HF_COMMAND_PORT = 48899
 HF_COMMAND = 'HF-A11ASSISTHREAD'.encode()
@@ -57,26 +75,187 @@ HF_COMMAND_OK = '+ok'.encode()
 
 prepare_hex = lambda x: format(x, 'x').zfill(2)
 
+# Progress through a transition, from 0 to 1, for the fraction of its time that has passed
+EASINGS = {
+    'linear': lambda t: t,
+    'ease-in': lambda t: t * t,
+    'ease-out': lambda t: t * (2 - t),
+    'ease-in-out': lambda t: t * t * (3 - 2 * t),
+}
+
+
+class MagicHomeConnection:
+    """
+    A long-lived connection to one bulb, shared by everything in this process that talks to it. Writes are
+    serialized, and a connection the bulb dropped is reopened transparently. After a failed connect, further attempts
+    back off exponentially, so callers fail fast instead of each waiting out a timeout. Quiet connections are kept
+    open with state queries until they haven't been used for a while.
+    """
+
+    def __init__(self, host: str, port: int = CONTROL_PORT):
+        self.host = host
+        self.port = port
+        self.sock = None
+        self.lock = RLock()
+        self.failures = 0
+        self.retry_at = 0
+        # Last command from a driver, and last traffic of any kind
+        self.last_used = 0
+        self.last_io = 0
+        # Requests waiting for a reply, by request, so concurrent identical queries share one round trip
+        self.pending = {}
+        self.pending_lock = Lock()
+
+    def send(self, data: bytes) -> None:
+        """
+        :raises OSError: The bulb can't be reached
+        """
+        with self.lock:
+            self.last_used = monotonic()
+            for attempt in range(2):
+                sock = self._connect()
+                try:
+                    sock.sendall(data)
+                    self.last_io = monotonic()
+                    return
+                except OSError:
+                    self.close()
+                    if attempt:
+                        raise
+
+    def request(self, data: bytes, length: int) -> bytes:
+        """
+        Send a query and read its fixed-length reply. A caller asking the same while a query is already waiting for
+        its reply gets that reply instead of sending another.
+        :raises OSError: The bulb can't be reached or didn't reply in time
+        """
+        with self.pending_lock:
+            future = self.pending.get(data)
+            owner = future is None
+            if owner:
+                future = self.pending[data] = Future()
+        if not owner:
+            return future.result()
+        try:
+            self.last_used = monotonic()
+            reply = self._request(data, length)
+            future.set_result(reply)
+            return reply
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.pending_lock:
+                del self.pending[data]
+
+    def connect(self) -> None:
+        """
+        Open the connection ahead of a command, unless it is open already.
+        :raises OSError: The bulb can't be reached
+        """
+        with self.lock:
+            self._connect()
+
+    def close(self) -> None:
+        with self.lock:
+            if self.sock is not None:
+                self.sock.close()
+                self.sock = None
+
+    def _request(self, data: bytes, length: int) -> bytes:
+        with self.lock:
+            for attempt in range(2):
+                sock = self._connect()
+                try:
+                    sock.sendall(data)
+                    reply = b''
+                    while len(reply) < length:
+                        chunk = sock.recv(length - len(reply))
+                        if not chunk:
+                            raise ConnectionResetError("{} closed the connection".format(self.host))
+                        reply += chunk
+                    self.last_io = monotonic()
+                    return reply
+                except socket.timeout:
+                    self.close()
+                    raise
+                except OSError:
+                    self.close()
+                    if attempt:
+                        raise
+
+    def _connect(self) -> socket.socket:
+        if self.sock is not None:
+            if self._alive():
+                return self.sock
+            self.close()
+        if monotonic() < self.retry_at:
+            raise ConnectionError("{} is unreachable, retrying in {:.0f}s".format(self.host,
+                                                                                  self.retry_at - monotonic()))
+        try:
+            sock = socket.create_connection((self.host, self.port), timeout=TIMEOUT)
+        except OSError:
+            self.failures += 1
+            self.retry_at = monotonic() + min(2 ** (self.failures - 1), MAX_BACKOFF)
+            raise
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.failures = 0
+        self.sock = sock
+        self.last_io = monotonic()
+        timer.call_later(KEEPALIVE, thread_runner, self._keepalive, sock)
+        return sock
+
+    def _alive(self) -> bool:
+        """
+        Discard replies nobody waits for, e.g. to color changes, and tell whether the bulb closed the connection.
+        """
+        try:
+            while select.select([self.sock], [], [], 0)[0]:
+                if not self.sock.recv(4096):
+                    return False
+        except OSError:
+            return False
+        return True
+
+    def _keepalive(self, sock: socket.socket) -> None:
+        with self.lock:
+            if sock is not self.sock:
+                return
+            if monotonic() - self.last_used >= IDLE_TIMEOUT:
+                self.close()
+                return
+            if monotonic() - self.last_io >= KEEPALIVE:
+                try:
+                    self._request(STATE_QUERY, 14)
+                except OSError:
+                    return
+        timer.call_later(KEEPALIVE, thread_runner, self._keepalive, sock)
+
+
+connections = {}
+connections_lock = Lock()
+# Connections aren't shared with forked worker processes, which open their own
+connections_pid = None
+
+
+def get_connection(host: str) -> MagicHomeConnection:
+    global connections_pid
+    with connections_lock:
+        if connections_pid != os.getpid():
+            connections.clear()
+            connections_pid = os.getpid()
+        if host not in connections:
+            connections[host] = MagicHomeConnection(host)
+        return connections[host]
+
 
 def calc_sunlight() -> int:
     """
     Calculate an appropriate brightness for the bulb depending on
-    current sunlight.
+    current sunlight, looked up in the day's precomputed table.
     :return: White brightness
     """
-    a = Astral()
-    a.solar_depression = 'civil'
-    city = a[settings.LOCATION]
-    sun = city.sun(date=datetime.now(), local=True)
-    dt = datetime.now(sun['sunrise'].tzinfo)
-    if dt.hour < 4 or dt.hour >= 22:
-        return {'red': 255}
-    elif dt < sun['sunrise']:
-        return {'white': 255 - (sun['sunrise'] - dt).total_seconds() / 3600 * 200 / 6}
-    elif dt > sun['sunset']:
-        return {'white': 255 - (dt - sun['sunset']).total_seconds() / 3600 * 200 / 6}
-    else:
-        return {'white': 255}
+    return sunlight()
 
 
 class Bulb(Power):
@@ -173,10 +352,21 @@ class MagicHomeBulb(Bulb):
         checksum (sum of data fields)
     """
 
-    def __init__(self, host: str):
+    def __init__(self, host: str, fps: int = 30):
+        """
+        :param host: Address of the bulb
+        :param fps: Frames per second to send during fades and transitions
+        """
         self.host = host
+        self.fps = fps
         self.state = {}
 
+    def prepare(self) -> None:
+        """
+        Open the connection before a synchronized change, so only the command itself is left to send.
+        """
+        get_connection(self.host).connect()
+
     def auth(self) -> None:
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         s.sendto(HF_COMMAND, (self.host, HF_COMMAND_PORT))
@@ -188,6 +378,152 @@ class MagicHomeBulb(Bulb):
         Provided RGB values and a brightness, change the color of the
         bulb with a TCP socket.
         """
+        data = self._packet(red, green, blue, white, brightness, mode, function, speed)
+        try:
+            get_connection(self.host).send(data)
+        except OSError as e:
+            print(e)
+        else:
+            if not function:
+                self._publish(data[1:5])
+
+    async def async_change_color(self, red: int = 0, green: int = 0, blue: int = 0, white: int = 0,
+                                 brightness: int = 255, mode: str = '31', function: str = None,
+                                 speed: str = '1f') -> None:
+        data = self._packet(red, green, blue, white, brightness, mode, function, speed)
+        try:
+            await self._async_send(data)
+        except (OSError, asyncio.TimeoutError) as e:
+            print(e)
+        else:
+            if not function:
+                self._publish(data[1:5])
+
+    def animate(self, colors: List, transition: str = 'gradual', speed: str = '1f') -> None:
+        """
+        Upload a sequence of colors as a custom mode program, which the bulb then cycles through by itself until it
+        is given another color or mode.
+        :param colors: Up to 16 colors, each a hex code like '#ff0000', a list of red, green and blue, or a dict of
+        red, green and blue
+        :param transition: gradual, jumping or strobe
+        :param speed: 1f (slowest) to 01 (fastest)
+        """
+        try:
+            get_connection(self.host).send(self._program(colors, transition, speed))
+        except OSError as e:
+            print(e)
+
+    def _program(self, colors: List, transition: str = 'gradual', speed: str = '1f') -> bytearray:
+        """
+        Build the custom mode packet for a color sequence, including its checksum.
+        """
+        if len(colors) > CUSTOM_SLOTS:
+            raise ValueError("A custom mode program holds at most {} colors".format(CUSTOM_SLOTS))
+        if transition not in CUSTOM_TRANSITIONS:
+            raise NotImplementedError
+        speed = int(speed, 16)
+        if not 0x01 <= speed <= 0x1f:
+            raise ValueError("Speed must be between 01 and 1f")
+        data = bytearray([0x51])
+        for color in colors:
+            if isinstance(color, str):
+                rgb = RGBfromhex(color)
+            elif isinstance(color, dict):
+                rgb = to_int(color.get('red', 0), color.get('green', 0), color.get('blue', 0))
+            else:
+                rgb = to_int(*color)
+            data += bytes(rgb) + b'\x00'
+        data += CUSTOM_EMPTY_SLOT * (CUSTOM_SLOTS - len(colors))
+        data += bytes([speed, CUSTOM_TRANSITIONS[transition], 0xff]) + bytes.fromhex(TAIL)
+        data.append(sum(data) % 256)
+        return data
+
+    def fade(self, start: Dict = None, stop: Dict = None, bright: int = None, speed: int = 1,
+             duration: float = None, easing: str = 'linear') -> Dict:
+        """
+        Fade the start color out, then the stop color in.
+        :param bright: Brightness to fade the start color out from, or the stop color in from
+        :param speed: Brightness change per frame, setting how long each part takes unless `duration` is given
+        :param duration: Seconds each part of the fade takes
+        :param easing: One of linear, ease-in, ease-out or ease-in-out
+        :return: Frame counts and time taken, see `play`
+        """
+        speed = abs(speed) or 1
+        parts = []
+        if start:
+            parts.append((start, bright or 255, 0))
+            bright = 0
+        if stop:
+            parts.append((stop, bright or 0, 255))
+        return self.play([(self._brightness_frames(color, first, last),
+                           duration if duration is not None else abs(last - first) / speed / self.fps)
+                          for color, first, last in parts], easing)
+
+    def transition(self, red: int = 0, green: int = 0, blue: int = 0, white: int = 0, duration: float = 1,
+                   easing: str = 'linear') -> Dict:
+        """
+        Change gradually from the bulb's last known color to the given one.
+        :return: Frame counts and time taken, see `play`
+        """
+        source = self.state or {}
+        target = dict(zip(('red', 'green', 'blue', 'white'), to_int(red, green, blue, white)))
+
+        def frame(progress: float) -> bytearray:
+            return self._packet(**{key: round(source.get(key, 0) + (value - source.get(key, 0)) * progress)
+                                   for key, value in target.items()}, mode='41')
+
+        return self.play([(frame, duration)], easing)
+
+    def _brightness_frames(self, color: Dict, first: int, last: int) -> Callable[[float], bytearray]:
+        return lambda progress: self._packet(**color, brightness=round(first + (last - first) * progress), mode='41')
+
+    def play(self, transitions: List[Tuple[Callable[[float], bytearray], float]], easing: str = 'linear') -> Dict:
+        """
+        Send the frames of one or more transitions over the bulb's connection, at the bulb's frame rate. A frame that
+        is already a frame late is dropped, except the last one of each transition, so transitions take the time
+        they were given and end on their final color. Stops after the current frame if its task is cancelled.
+        :param transitions: A function building the packet for a progress from 0 to 1, and the transition's duration
+        :param easing: One of linear, ease-in, ease-out or ease-in-out
+        :return: The number of frames sent and dropped, and the seconds taken
+        """
+        ease = EASINGS[easing]
+        interval = 1 / self.fps
+        connection = get_connection(self.host)
+        sent = dropped = 0
+        started = monotonic()
+        packet = None
+        try:
+            for build, duration in transitions:
+                count = max(1, round(duration * self.fps))
+                begin = monotonic()
+                for i in range(1, count + 1):
+                    if cancel_requested():
+                        raise CancelledError()
+                    late = monotonic() - (begin + i * interval)
+                    if late > interval and i < count:
+                        dropped += 1
+                        continue
+                    if late < 0:
+                        sleep(-late)
+                    frame = build(ease(i / count))
+                    connection.send(frame)
+                    packet = frame
+                    sent += 1
+        except OSError as e:
+            print(e)
+        except CancelledError:
+            print("{} stopped after {} frames".format(self.host, sent))
+        if packet:
+            self._publish(packet[1:5])
+        if dropped:
+            print("{} dropped {} of {} frames".format(self.host, dropped, sent + dropped))
+        return {'sent': sent, 'dropped': dropped, 'seconds': monotonic() - started}
+
+    def _packet(self, red: int = 0, green: int = 0, blue: int = 0, white: int = 0, brightness: int = 255,
+                mode: str = '31', function: str = None, speed: str = '1f') -> bytearray:
+        """
+        Build the packet for a color or function, including its checksum.
+        """
         if mode not in SUPPORTED_MODES:
             raise NotImplementedError
 
@@ -210,16 +546,9 @@ class MagicHomeBulb(Bulb):
             # Build packet
             data = bytearray.fromhex(mode + color_hex
                                      + color_mode + TAIL)
-        try:
-            # Compute checksum
-            data.append(sum(data) % 256)
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(20)
-            sock.connect((self.host, CONTROL_PORT))
-            sock.send(data)
-            sock.close()
-        except Exception as e:
-            print(e)
+        # Compute checksum
+        data.append(sum(data) % 256)
+        return data
 
     def power(self, on: bool):
         if on:
@@ -228,63 +557,103 @@ class MagicHomeBulb(Bulb):
             self.change_color(white=0)
 
     def get_state(self):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((self.host, CONTROL_PORT))
-        sock.send(bytes([0x81, 0x8A, 0x8B, 0x96]))
-        r = sock.recv(14)
-        sock.close()
-        if len(r) == 14:
-            return {'red': r[6], 'green': r[7], 'blue': r[8], 'white': r[9]}
+        try:
+            r = get_connection(self.host).request(STATE_QUERY, 14)
+        except OSError as e:
+            print(e)
+            return None
+        return self._publish(r[6:10])
+
+    async def async_get_state(self):
+        try:
+            r = await self._async_send(STATE_QUERY, 14)
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+            print(e)
+            return None
+        return self._publish(r[6:10])
+
+    async def _async_send(self, data: bytes, reply: int = 0) -> bytes:
+        """
+        Send a packet over a connection of its own on the event loop, rather than the shared blocking one, and read
+        its fixed-length reply, if any.
+        """
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, CONTROL_PORT), TIMEOUT)
+        try:
+            writer.write(data)
+            await writer.drain()
+            return await asyncio.wait_for(reader.readexactly(reply), TIMEOUT) if reply else b''
+        finally:
+            writer.close()
+
+    def _publish(self, rgbw: bytes) -> Dict:
+        """
+        Remember the bulb's color and share it with other processes.
+        """
+        self.state = {'red': rgbw[0], 'green': rgbw[1], 'blue': rgbw[2], 'white': rgbw[3]}
+        publish_state(self, self.state)
+        return self.state
+
+
+@lru_cache(maxsize=None)
+def get_smart_bulb(host: str) -> SmartBulb:
+    return SmartBulb(host=host)
 
 
 class KasaBulb(Bulb):
+    """
+    TP-Link Kasa bulbs. Changes are sent as one light state each, and fades are done by the bulb itself with a
+    transition period, in milliseconds.
+    """
+
     def __init__(self, host: str = None):
         self.host = host
 
     def _get_bulb(self) -> SmartBulb:
-        return SmartBulb(host=self.host)
+        return get_smart_bulb(self.host)
+
+    def _set_light_state(self, transition_period: int = 0, **state) -> Dict:
+        if transition_period:
+            state['transition_period'] = int(transition_period)
+        return self._get_bulb().set_light_state(state)
 
-    def change_color(self, red: int = 0, green: int = 0, blue: int = 0, hex_code: str = None, *args, **kwargs):
+    def change_color(self, red: int = 0, green: int = 0, blue: int = 0, hex_code: str = None,
+                     transition_period: int = 0, *args, **kwargs):
         if hex_code:
             red, green, blue = RGBfromhex(hex_code)
-        bulb = self._get_bulb()
-        bulb.turn_on()
-        h1, h2, br = colorsys.rgb_to_hsv(red, green, blue)
-        bulb.hsv = (int(h1 * 360), int(h2 * 100), br // 255 * 100)
+        h1, h2, br = colorsys.rgb_to_hsv(*to_int(red, green, blue))
+        self._set_light_state(transition_period, on_off=1, hue=int(h1 * 360), saturation=int(h2 * 100),
+                              brightness=round(br / 255 * 100), color_temp=0)
 
-    def power(self, on: bool):
-        bulb = self._get_bulb()
+    def power(self, on: bool, transition_period: int = 0):
         if on:
-            bulb.turn_on()
-            bulb.hsv = (0, 0, 100)
+            self._set_light_state(transition_period, on_off=1, hue=0, saturation=0, brightness=100, color_temp=0)
         else:
-            bulb.turn_off()
+            self._set_light_state(transition_period, on_off=0)
 
     def get_state(self):
         return self._get_bulb().state
 
-    def fade(self, start: int = 0, stop: int = 100, speed: int = 1, pause: float = 0) -> None:
-        bulb = self._get_bulb()
-        speed = abs(speed)
-        bulb.set_light_state({'on_off': 1, 'mode': 'normal', 'hue': 0, 'saturation': 0,
-                              'color_temp': 0, 'brightness': start})
-        if start > stop:
-            bright = start
-            while bright >= 0:
-                bulb.set_brightness(bright)
-                bright -= speed
-                sleep(pause)
+    def fade(self, start: int = 0, stop: int = 100, speed: int = 1, pause: float = 0, duration: float = None) -> None:
+        """
+        Set the start brightness, then have the bulb fade to the stop brightness, turning off at 0.
+        :param speed: Brightness change per step, which with `pause` sets the duration unless it is given
+        :param duration: Seconds the fade takes
+        """
+        if duration is None:
+            duration = abs(stop - start) / (abs(speed) or 1) * max(pause, 0.03)
+        self._set_light_state(on_off=1, mode='normal', hue=0, saturation=0, color_temp=0, brightness=start)
+        if stop > 0:
+            self._set_light_state(duration * 1000, on_off=1, brightness=stop)
         else:
-            bright = start
-            while bright <= 100:
-                bulb.set_brightness(bright)
-                bright += speed
-                sleep(pause)
+            self._set_light_state(duration * 1000, on_off=0)
 
-    def sunlight(self) -> None:
-        bulb = self._get_bulb()
-        bulb.hsv = (0, 0, 0)
-        bulb.brightness = calc_sunlight()['white'] / 255 * 100
+    def sunlight(self, transition_period: int = 0) -> None:
+        color = calc_sunlight()
+        if 'white' in color:
+            self._set_light_state(transition_period, on_off=1, hue=0, saturation=0, color_temp=0,
+                                  brightness=round(color['white'] / 255 * 100))
+        else:
+            self.change_color(**color, transition_period=transition_period)
 
 
 @socketio.on('change color')
@@ -299,9 +668,11 @@ def request_change_color(message):
         return
     emit('push color', {"device": message['device'], "color": message['color']},
          broadcast=True)
-    device.dev.change_color(*utils.RGBfromhex(message['color']),
-                            utils.to_int(message.get('white', 0)), message.get('bright', 100), '41'
-                            )
+    red, green, blue = utils.RGBfromhex(message['color'])
+    # Queued behind the device's other commands; with `coalesce: [change_color]`, only the newest color waits
+    run(device.dev.change_color, thread=True, device=device.name, executor=device.driver.executor_for('change_color'),
+        red=red, green=green, blue=blue, white=utils.to_int(message.get('white', 0)),
+        brightness=message.get('bright', 100), mode='41')
 
 
 @socketio.on('outmap')
@@ -7,12 +7,12 @@ Module to wrap pychromecast
 from functools import wraps
 from time import sleep
 
-import pychromecast
-
 from home import settings
 
 
 def get_chromecast(host: str = None, name: str = None):
+    import pychromecast
+
     if host:
         return pychromecast.Chromecast(host=host)
     elif name:
@@ -2,19 +2,18 @@ import datetime
 import subprocess
 from typing import List
 
-import paramiko
-import redis
 import requests
 from flask_socketio import emit
 from time import sleep
 from wakeonlan import send_magic_packet
 
+from home.core.models import publish_state
 from home.core.tasks import run
 from home.core.utils import to_float
 from home.web.utils import ws_login_required
 from home.web.web import socketio
 
-storage = redis.StrictRedis(decode_responses=True)
+storage = None
 
 # Virsh will be queried at most once per this value
 SECONDS_BETWEEN_VIRSH_QUERY: float = 1.0
@@ -22,6 +21,18 @@ SECONDS_BETWEEN_VIRSH_QUERY: float = 1.0
 MAX_VIRSH_SUSPEND: int = 600
 
 
+def get_storage():
+    """
+    Connect to Redis on first use rather than at import time.
+    """
+    global storage
+    if storage is None:
+        import redis
+
+        storage = redis.StrictRedis(decode_responses=True)
+    return storage
+
+
 class Computer:
     widget = {
         'buttons': (
@@ -128,6 +139,8 @@ class Computer:
         username = user or self.username
         password = password or self.password
         keyfile = keyfile or self.keyfile
+        import paramiko
+
         ssh = paramiko.SSHClient()
         ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         ssh.connect(self.host,
@@ -167,10 +180,10 @@ class Computer:
         # maybe log failure
 
     def _enum_virsh(self):
-        last_check = datetime.datetime.fromtimestamp(to_float(storage.get(self._storage_key() + ":last")))
+        last_check = datetime.datetime.fromtimestamp(to_float(get_storage().get(self._storage_key() + ":last")))
         if not (datetime.datetime.now() - last_check).seconds >= self.virsh_seconds:
             return
-        storage.set(self._storage_key() + ":last", datetime.datetime.now().timestamp())
+        get_storage().set(self._storage_key() + ":last", datetime.datetime.now().timestamp())
         o = None
         try:
             if self.virt == 'http':
@@ -180,12 +193,12 @@ class Computer:
         except:
             pass
         finally:
-            storage.delete(self._storage_key())
+            get_storage().delete(self._storage_key())
         if not o:
             return
         for line in o[2:-1]:
             if line:
-                storage.rpush(self._storage_key(), line)
+                get_storage().rpush(self._storage_key(), line)
 
     def enum_virsh(self, blocking: bool = False):
         if blocking:
@@ -193,12 +206,13 @@ class Computer:
         else:
             run(self._enum_virsh)
         vms = set()
-        for line in storage.lrange(self._storage_key(), 0, -1):
+        for line in get_storage().lrange(self._storage_key(), 0, -1):
             if line:
                 line = line.split()
                 status = ' '.join(line[2:])
                 vms.add((line[1], status))
         self.vms = sorted(list(vms), key=lambda x: (x[1], x[0].lower()))
+        publish_state(self, self.vms, key='vms')
 
     def vm_power(self, vm: str, action: str = 'start'):
         if action in ('start', 'shutdown', 'reboot', 'suspend', 'resume', 'save', 'restore'):
@@ -10,7 +10,8 @@ import requests
 from flask_socketio import disconnect, emit
 from requests.auth import HTTPBasicAuth
 
-from home.core.models import get_device
+from home.core.models import get_device, publish_state
+from home.core.utils import fetch
 from home.web.utils import ws_optional_auth
 from home.web.web import socketio
 
@@ -90,16 +91,26 @@ class Mopidy:
         msg = {"jsonrpc": "2.0", "id": self.id, 'method': method, 'params': dict(kwargs)}
         return requests.post(self.host, data=json.dumps(msg)).json()
 
+    async def async_send(self, method, **kwargs):
+        msg = {"jsonrpc": "2.0", "id": self.id, 'method': method, 'params': dict(kwargs)}
+        _, _, body = await fetch(self.host, 'POST', json.dumps(msg).encode(),
+                                 {'Content-Type': 'application/json'})
+        return json.loads(body)
+
     def get_current_track(self):
         song = self.send('core.playback.get_current_tl_track')['result']['track']
         if not self.song or not song['uri'] == self.song['uri']:
             self.song = song
             self.song['art'] = self.spotify.get_album_art(song['album']['uri'].split(':')[2])
+            publish_state(self, self.song, key='track')
         return self.song
 
     def get_state(self):
         return self.send('core.playback.get_state')
 
+    async def async_get_state(self):
+        return await self.async_send('core.playback.get_state')
+
     def get_time_position(self):
         return self.send('core.playback.get_time_position')
 
@@ -109,24 +120,45 @@ class Mopidy:
     def next(self):
         return self.send('core.playback.next')
 
+    async def async_next(self):
+        return await self.async_send('core.playback.next')
+
     def pause(self):
         return self.send('core.playback.pause')
 
+    async def async_pause(self):
+        return await self.async_send('core.playback.pause')
+
     def play(self, track=None):
         return self.send('core.playback.play', tl_track=track)
 
+    async def async_play(self, track=None):
+        return await self.async_send('core.playback.play', tl_track=track)
+
     def previous(self):
         return self.send('core.playback.previous')
 
+    async def async_previous(self):
+        return await self.async_send('core.playback.previous')
+
     def clear(self):
         return self.send('core.tracklist.clear')
 
+    async def async_clear(self):
+        return await self.async_send('core.tracklist.clear')
+
     def resume(self):
         return self.send('core.playback.resume')
 
+    async def async_resume(self):
+        return await self.async_send('core.playback.resume')
+
     def stop(self):
         return self.send('core.playback.stop')
 
+    async def async_stop(self):
+        return await self.async_send('core.playback.stop')
+
     def get_playlists(self):
         return self.send('core.playlists.as_list')
 
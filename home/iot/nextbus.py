@@ -2,7 +2,7 @@ import datetime
 import requests
 from flask_socketio import emit
 
-from home.core.models import get_device
+from home.core.models import get_device, publish_state, read_state
 from home.web.utils import ws_login_required
 from home.web.web import socketio
 
@@ -31,6 +31,7 @@ class NextBus:
                     upcoming.append((p['routeTitle'], times))
         self.data_time = datetime.datetime.now()
         self.data = upcoming
+        publish_state(self, upcoming, key='predictions')
 
     def render_widget(self):
         return '<img src="https://www.stugov.iastate.edu/assets/images/logo.png" height="100"/><h1>Next Bus</h1><div' \
@@ -40,7 +41,13 @@ class NextBus:
 @socketio.on('next bus')
 @ws_login_required
 def next_bus():
-    nb = get_device('nextbus').dev
+    device = get_device('nextbus')
+    # Predictions may have been fetched by a worker process
+    predictions = read_state(device, max_age=5 * 60, key='predictions')
+    if predictions is not None:
+        emit('next bus data', predictions)
+        return
+    nb = device.dev
     if (datetime.datetime.now() - nb.data_time).total_seconds() / 60 >= 5:
         nb.get_predictions()
     emit('next bus data', nb.data)
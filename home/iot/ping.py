@@ -1,3 +1,4 @@
+import asyncio
 import socket
 from ast import literal_eval
 
@@ -22,15 +23,36 @@ class Ping:
         except Exception:
             return False
 
+    async def async_ping(self, host=None, port=None):
+        host = host or self.host
+        port = port or self.port
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), 10)
+            writer.close()
+            return True
+        except Exception:
+            return False
+
     def ping_all(self, hosts):
+        return self._report([(target, self.ping(target['host'], target['port'])) for target in hosts])
+
+    async def async_ping_all(self, hosts):
+        # Every host is pinged at once, instead of waiting up to the timeout for each in turn
+        results = await asyncio.gather(*(self.async_ping(target['host'], target['port']) for target in hosts))
+        # Sending notifications blocks, so keep it off the event loop
+        return await asyncio.get_running_loop().run_in_executor(None, self._report, list(zip(hosts, results)))
+
+    def _report(self, pings):
+        """
+        Notify subscribers of hosts that went down or came back since the last check.
+        """
         results = {}
         try:
             with open('.ping.last') as f:
                 last_results = literal_eval(f.read())
         except FileNotFoundError:
             last_results = {}
-        for target in hosts:
-            result = self.ping(target['host'], target['port'])
+        for target, result in pings:
             if not result and last_results.get(target['host'], True):
                 send_to_subscribers("Lost connectivity to " + target['host'])
             elif result and not last_results.get(target['host'], True):
@@ -6,9 +6,6 @@ Module for communicating with smart plugs
 """
 from abc import abstractmethod
 
-import broadlink
-from pyvesync import VeSync
-
 from home.iot.power import Power
 
 PORT = 80
@@ -44,6 +41,8 @@ class BroadlinkPlug(Plug):
         self.mac = mac
 
     def _get_plug(self):
+        import broadlink
+
         device = broadlink.gendevice(0x2711, (self.host, 80), bytearray.fromhex(self.mac.replace(':', '')))
         device.auth()
         return device
@@ -65,6 +64,8 @@ class EtekcityPlug(Plug):
         self.index = index
 
     def _get_plug(self):
+        from pyvesync import VeSync
+
         manager = VeSync(self.email, self.password, self.time_zone)
         manager.login()
         manager.update()
@@ -1,9 +1,7 @@
 from abc import ABC, abstractmethod
 from datetime import datetime, timedelta
 
-from astral import Astral
-
-from home import settings
+from home.core.sun import sun_events, today
 
 
 class Power(ABC):
@@ -14,10 +12,11 @@ class Power(ABC):
         self.power(False)
 
     def auto(self, action: str = 'on', sun_state: str = 'sunset', offset: int = 0):
-        a = Astral()
-        a.solar_depression = 'civil'
-        city = a[settings.LOCATION]
-        sun = city.sun(date=datetime.now(), local=True)
+        """
+        Turn on or off if the sun event has passed. Scheduling the method with the 'sun' trigger instead of
+        checking it repeatedly runs it only when the event happens.
+        """
+        sun = sun_events(today())
         if datetime.now(sun[sun_state].tzinfo) >= sun[sun_state] + timedelta(seconds=offset):
             {'on': self.on,
              'off': self.off}[action]()
@@ -6,7 +6,7 @@ from flask_login import current_user
 from flask_socketio import disconnect, emit
 
 from home import settings
-from home.core.models import get_action, devices
+from home.core.models import get_action, get_registry
 from home.web.models import SecurityEvent, SecurityController
 from home.web.utils import send_to_subscribers, ws_login_required
 from home.web.web import socketio
@@ -58,11 +58,11 @@ def change_state():
     if sec.state == 'disabled':
         # Set to armed
         sec.arm()
-        message = get_action('arm').run()
+        get_action('arm').run()
     elif sec.state == 'armed':
         # Set to disabled
         sec.disable()
-        message = get_action('disable').run()
+        get_action('disable').run()
     elif sec.state == 'alert':
         # Restore to armed
         sec.arm()
@@ -72,7 +72,8 @@ def change_state():
 @socketio.on('get feeds')
 @ws_login_required
 def get_feeds():
-    feeds = [d.name for d in devices if d.driver.name == 'motion' and current_user.has_permission(d)]
+    feeds = [d.name for d in get_registry().devices.values() if d.driver and d.driver.name == 'motion' and
+             current_user.has_permission(d)]
     emit('push video', {'feeds': feeds})
 
 
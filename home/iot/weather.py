@@ -1,11 +1,13 @@
 import calendar
 import datetime
+import json
 import random
 
 import requests
 from flask import request, abort
 
 from home.core.models import get_device
+from home.core.utils import fetch
 from home.iot.speech import Speech, message, part_of_day
 from home.web.utils import api_auth_required
 from home.web.web import app
@@ -73,6 +75,18 @@ class Weather:
         self.api_key = api_key
 
     def get(self, city_id=None, zipcode=None, latlon=None, name=None, mode='weather'):
+        r = requests.get(self._url(city_id, zipcode, latlon, name, mode))
+        if not r.status_code == 200 or not 'json' in r.headers['content-type']:
+            raise Exception("Invalid response from OpenWeatherMap")
+        return Forecast(r.json())
+
+    async def async_get(self, city_id=None, zipcode=None, latlon=None, name=None, mode='weather'):
+        status, headers, body = await fetch(self._url(city_id, zipcode, latlon, name, mode))
+        if not status == 200 or not 'json' in headers.get('content-type', ''):
+            raise Exception("Invalid response from OpenWeatherMap")
+        return Forecast(json.loads(body))
+
+    def _url(self, city_id=None, zipcode=None, latlon=None, name=None, mode='weather'):
         if city_id:
             loc = "id=" + str(city_id)
         elif zipcode:
@@ -82,10 +96,7 @@ class Weather:
         elif name:
             loc = "q=" + name
         uri = '?{}&APPID={}&units=imperial'.format(loc, self.api_key)
-        r = requests.get(BASE_URL + mode + uri)
-        if not r.status_code == 200 or not 'json' in r.headers['content-type']:
-            raise Exception("Invalid response from OpenWeatherMap")
-        return Forecast(r.json())
+        return BASE_URL + mode + uri
 
     @staticmethod
     def render_widget(lat, lon):
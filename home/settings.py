@@ -19,6 +19,7 @@ LDAP_FILTER = "uid={}"
 LDAP_ADMIN_GROUP = 'cn=admins,dc=example,dc=com'
 LDAP_BASE_DN = 'cn=users,dc=example,dc=com'
 SPOTIFY_API_KEY = 'your_key_here'
+# 'multiprocessing', 'celery', or 'workers' to keep a copy of the devices in each worker process
 ASYNC_MODE = 'multiprocessing'
 MEDIA_TEST_URI = '/test.mp4'
 SENTRY_URL = ''
@@ -32,6 +33,25 @@ BROKER_PATH = 'redis://'
 CUSTOM_AUTH_HANDLERS = []
 MAX_THREADS = 100
 MAX_PROCESSES = 32
+MAX_SETUP_THREADS = 16
+# Number of finished tasks to keep for listing, besides the ones still running
+TASK_HISTORY = 100
+# Bytes of shared memory for each device's published state
+STATE_SLOT_SIZE = 4096
+# Seconds a device's published state is shown before asking the device again
+STATE_MAX_AGE = 5
+# Seconds between background polls of each device's state, unless its driver sets `poll_interval`; 0 to not poll.
+#  Some drivers log in to a cloud service or authenticate again for every state query, so polling is opt-in
+STATE_POLL_INTERVAL = 0
+# Seconds synchronized calls to several devices wait for all of them to be ready before going ahead anyway
+SYNC_TIMEOUT = 1
+CONFIG_CACHE = '.config.cache'
+# SQLite file to keep cron jobs in, so they keep their schedule across restarts; '' keeps them in memory
+JOB_STORE = ''
+# Seconds late a cron job may still run, e.g. after a restart; later runs are skipped
+JOB_MISFIRE_GRACE = 300
+# Import driver modules only once a device needs them, instead of when the config is loaded
+LAZY_DRIVERS = False
 # db = MySQLDatabase(host="localhost", database="home", user="home", passwd="home")
 
 try:
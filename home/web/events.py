@@ -1,10 +1,14 @@
+from concurrent.futures import TimeoutError
+
+from flask import request
 from flask_login import current_user
-from flask_socketio import emit, disconnect
+from flask_socketio import emit, disconnect, join_room
 from time import sleep
 
 from home.core import utils as utils, parser as parser
-from home.core.models import get_action, get_interface, widgets, MultiDevice
-from home.core.tasks import run
+from home.core.models import get_action, get_interface, get_registry, Device, MultiDevice, read_state
+from home.core.poller import poller
+from home.core.tasks import run, call, device_queues, task_registry, TrackedTask
 from home.core.utils import random_string
 from home.settings import LOG_FILE
 from home.web.models import APIClient, User, Subscriber, gen_token
@@ -21,7 +25,7 @@ def ws_admin(data):
     command = data.get('command')
     if command == 'action':
         app.logger.info("({}) Execute action '{}'".format(current_user.username, data.get('action')))
-        get_action(data.get('action')).run()
+        get_action(data.get('action')).run(origin=current_user.username)
         emit('message', {'class': 'alert-success',
                          'content': "Executing action '{}'.".format(data.get('action'))
                          })
@@ -78,22 +82,35 @@ def ws_admin(data):
         emit('display refresh', broadcast=True)
     elif command == 'update config':
         try:
-            parser.parse(data=data['config'])
+            elapsed = parser.parse(data=data['config'], incremental=True)
         except Exception as e:
-            parser.parse(file='config.yml')
+            # The previous config stays active when the new one fails to load
             emit('message', {'class': 'alert-danger',
                              'content': 'Error parsing device configuration. ' + str(e)})
         else:
             with open('config.yml', 'w') as f:
                 f.write(data['config'])
+            app.logger.info("({}) Updated device config in {:.3f}s".format(current_user.username, elapsed))
             emit('message', {'class': 'alert-success',
-                             'content': 'Successfully updated device configuration.'})
+                             'content': 'Successfully updated device configuration ({:.2f}s).'.format(elapsed)})
     elif command == 'refresh logs':
         with open(LOG_FILE) as f:
             emit('logs', f.read())
     elif command == 'get config':
         with open('config.yml') as f:
             emit('config', f.read())
+    elif command == 'queue depth':
+        emit('queue depth', device_queues.depth())
+    elif command == 'tasks':
+        emit('tasks', [task.as_dict() for task in task_registry.list()])
+    elif command == 'cancel task':
+        if task_registry.cancel(data.get('id')):
+            emit('message', {'class': 'alert-success',
+                             'content': 'Cancelled task.'})
+        else:
+            emit('message', {'class': 'alert-warning',
+                             'content': "Couldn't cancel task; it has already started or finished."})
+        emit('tasks', [task.as_dict() for task in task_registry.list()])
 
 
 @socketio.on('update')
@@ -108,7 +125,7 @@ def ws_update():
 @ws_login_required
 def widget(data):
     try:
-        target = widgets[data['id']]
+        target = get_registry().widgets[data['id']]
     except KeyError:
         # Widget is out of date. Force client reload
         send_message("Interface out of date; reloading", "warning")
@@ -123,20 +140,27 @@ def widget(data):
                                                               target[2]))
             func = target[1]
             args = target[2]
+            task = None
+            executor = target[3].driver.executor_for(name) if type(target[3]) is not MultiDevice else None
             try:
-                if target[3].driver.noserialize or type(target[3]) is MultiDevice:
+                if executor is None and (target[3].driver.noserialize or type(target[3]) is MultiDevice):
                     func(**args)
                 else:
-                    run(func, **args)
+                    task = run(func, device=target[3].name, origin=current_user.username, executor=executor, **args)
             except Exception as e:
                 app.logger.error("Error running {}: {}".format(name, str(e)))
                 send_message("Error running \"{}\"!".format(name), 'danger')
             else:
-                send_message("Successfully ran \"{}\".".format(name), 'success')
+                if task:
+                    send_message("Running \"{}\"...".format(name))
+                    sid = request.sid
+                    task.add_done_callback(lambda t: report_task(t, sid))
+                else:
+                    send_message("Successfully ran \"{}\".".format(name), 'success')
         elif target[0] == 'action':
             app.logger.info("({}) Execute action {}".format(current_user.username, target[1]))
             send_message("Executing action \"{}\"".format(target[1]))
-            target[1].run()
+            target[1].run(origin=current_user.username)
     else:
         disconnect()
 
@@ -144,12 +168,31 @@ def widget(data):
 @socketio.on("device state")
 @ws_login_required(check_device=True)
 def device_state(data, device):
+    # The client is sent the device's state whenever the poller finds it changed
+    join_room(state_room(device))
     try:
-        emit('device state', {'device': device.name, 'state': device.dev.get_state()})
-    except AttributeError:
+        state = read_state(device, max_age=poller.max_age(device))
+        if state is None:
+            state = call(device.dev.get_state, timeout=10)
+        emit('device state', {'device': device.name, 'state': state})
+    except (AttributeError, TimeoutError):
         emit('device state', {'device': device.name, 'state': None})
 
 
+def state_room(device: Device) -> str:
+    return 'state ' + device.name
+
+
+def push_state(device: Device, state) -> None:
+    """
+    Send a device's new state to the clients showing it.
+    """
+    socketio.emit('device state', {'device': device.name, 'state': state}, room=state_room(device))
+
+
+poller.subscribe(push_state)
+
+
 @socketio.on('subscribe')
 @ws_login_required
 def subscribe(subscriber):
@@ -175,3 +218,23 @@ def send_message(msg: str, style: str = 'info'):
          {'class': 'alert-' + style,
           'content': msg
           })
+
+
+def report_task(task: TrackedTask, sid: str) -> None:
+    """
+    Tell the client that started a task how it finished. Called from the worker that completed the task.
+    """
+    state = task.state
+    socketio.emit('task', task.as_dict(), room=sid)
+    if state == 'done':
+        result = task.outcome()
+        content = "Successfully ran \"{}\"{}".format(task.method, ": " + str(result) if result is not None else ".")
+        style = 'success'
+    elif state == 'failed':
+        app.logger.error("Error running {}: {}".format(task.method, task.outcome()))
+        content = "Error running \"{}\"!".format(task.method)
+        style = 'danger'
+    else:
+        content = "Cancelled \"{}\".".format(task.method)
+        style = 'warning'
+    socketio.emit('message', {'class': 'alert-' + style, 'content': content}, room=sid)
@@ -6,6 +6,10 @@ ws.emit('admin', {
     command: 'get config',
 });
 
+ws.emit('admin', {
+    command: 'tasks',
+});
+
 function editDevice() {
     ws.emit('admin', {
         action: 'add',
@@ -78,6 +82,47 @@ ws.on('logs', function (logs) {
     $('#logs').html(logs);
 });
 
+$('#refresh_queues').click(function () {
+    ws.emit('admin', {
+        command: 'queue depth',
+    });
+});
+
+ws.on('queue depth', function (depths) {
+    let lines = Object.keys(depths).map(function (device) {
+        return device + ': ' + depths[device];
+    });
+    $('#queue_depth').text(lines.length ? lines.join('\n') : 'No devices busy');
+});
+
+$('#refresh_tasks').click(function () {
+    ws.emit('admin', {
+        command: 'tasks',
+    });
+});
+
+function cancel_task(id) {
+    ws.emit('admin', {command: 'cancel task', id: id});
+}
+
+ws.on('tasks', function (tasks) {
+    let rows = $('#tasks').empty();
+    tasks.reverse().forEach(function (task) {
+        let row = $('<tr>');
+        [task.device, task.method, task.origin, new Date(task.started * 1000).toLocaleTimeString(), task.state]
+            .forEach(function (value) {
+                row.append($('<td>').text(value || ''));
+            });
+        let cancel = $('<td>');
+        if (task.state === 'pending' || task.state === 'running') {
+            cancel.append($('<a href="javascript:void(0);">Cancel</a>').click(function () {
+                cancel_task(task.id);
+            }));
+        }
+        rows.append(row.append(cancel));
+    });
+});
+
 $(".regen").click(function () {
     var client = $(this).attr('id');
     client = client.slice(client.indexOf('-') + 1);
@@ -12,12 +12,11 @@ from flask import request
 from flask import session
 from flask_login import current_user
 from flask_socketio import disconnect
-from ldap3 import Server, Connection, ALL_ATTRIBUTES
 from peewee import DoesNotExist
 
-from home.core.models import get_device, devices, actions, MultiDevice
+from home.core.models import get_device, get_registry, MultiDevice, Registry
 from home.core.tasks import run
-from home.core.utils import random_string, method_from_name, get_groups
+from home.core.utils import random_string, method_from_name
 from home.settings import BASE_URL, LDAP_BASE_DN, LDAP_FILTER, LDAP_HOST, LDAP_PORT, LDAP_SSL, \
     LDAP_ADMIN_GROUP, DEBUG
 from home.web.models import APIClient, Subscriber, User
@@ -175,10 +174,11 @@ def handle_task(post: dict, client: APIClient) -> bool:
         return False
     app.logger.info(
         "({}) Execute '{}' on '{}' with config {}".format(client.name, method.__name__, device.name, post))
-    if device.driver.noserialize or type(device) is MultiDevice:
+    executor = device.driver.executor_for(method.__name__) if type(device) is not MultiDevice else None
+    if executor is None and (device.driver.noserialize or type(device) is MultiDevice):
         method(**post)
     else:
-        device.last_task = run(method, **post)
+        run(method, device=device.name, origin=client.name, executor=executor, **post)
     return True
 
 
@@ -195,9 +195,10 @@ def get_qr() -> (str, str):
     return guest_path_qr, guest_path
 
 
-def get_widgets(user: User) -> List[str]:
+def get_widgets(user: User, registry: Registry = None) -> List[str]:
+    registry = registry or get_registry()
     widget_html = []
-    for d in devices.values():
+    for d in registry.devices.values():
         if user.has_permission(d):
             try:
                 widget_html.append(d.widget['html'])
@@ -206,9 +207,10 @@ def get_widgets(user: User) -> List[str]:
     return widget_html
 
 
-def get_action_widgets(user: User) -> List[str]:
+def get_action_widgets(user: User, registry: Registry = None) -> List[str]:
+    registry = registry or get_registry()
     widget_html = []
-    groups = get_groups(actions)
+    groups = registry.get_actions_by_group()
     for group in groups:
         if user.has_permission(group=group):
             html = ''
@@ -228,6 +230,8 @@ def get_action_widgets(user: User) -> List[str]:
 
 
 def ldap_auth(username: str, password: str) -> User:
+    from ldap3 import Server, Connection, ALL_ATTRIBUTES
+
     s = Server(host=LDAP_HOST, port=LDAP_PORT, use_ssl=LDAP_SSL)
     c = Connection(s, user=(LDAP_FILTER.format(username) + ',' + LDAP_BASE_DN), password=password)
     u = None
@@ -11,13 +11,13 @@ from flask import Flask, render_template, request, redirect, abort, url_for, ses
 from flask_login import LoginManager, login_required, current_user
 from flask_login import login_user, logout_user
 from flask_socketio import SocketIO
-from ldap3.core.exceptions import LDAPException
 from peewee import DoesNotExist
 from webassets.loaders import PythonLoader as PythonAssetsLoader
 
 import home.core.parser as parser
 import home.core.utils as utils
-from home.core.models import devices, interfaces, get_action, actions, get_driver, get_display, displays
+from home.core.models import get_action, get_driver, get_registry
+from home.core.tasks import task_registry
 from home.settings import SECRET_KEY, CUSTOM_AUTH_HANDLERS, BASE_URL
 from home.web.models import *
 from home.web.models import User, APIClient
@@ -66,24 +66,26 @@ def index():
     """
     sec = SecurityController.get()
     events = sec.events
+    registry = get_registry()
+    devices = registry.devices
     interface_list = []
-    for i in interfaces:
-        interface_list.append((i, [d for d in devices.values() if d.driver and d.driver.interface == i and
-                                   (i.public or current_user.is_authenticated and current_user.has_permission(d))]))
+    for i in registry.interfaces:
+        interface_list.append((i, [d for d in registry.get_devices_by_interface(i) if
+                                   i.public or current_user.is_authenticated and current_user.has_permission(d)]))
     if current_user.is_active:
-        widget_html = get_widgets(current_user) + get_action_widgets(current_user)
+        widget_html = get_widgets(current_user, registry) + get_action_widgets(current_user, registry)
         return render_template('index.html',
                                interfaces=interface_list,
                                devices=filter_by_permission(current_user, devices.values()),
                                sec=sec,
                                events=events,
                                clients=APIClient.select(),
-                               actions=filter_by_permission(current_user, actions),
+                               actions=filter_by_permission(current_user, registry.actions),
                                version=VERSION,
                                debug=DEBUG,
                                qr=get_qr(),
                                widgets=widget_html,
-                               displays=displays,
+                               displays=registry.displays,
                                users=User.select(),
                                run_session=run_session,
                                )
@@ -120,7 +122,7 @@ def command_api(client):
         action = get_action(action)
         if client.has_permission(action.group):
             app.logger.info("({}) Execute action {}".format(client.name, action))
-            action.run()
+            action.run(origin=client.name)
         else:
             app.logger.warning("({}) Insufficient API permissions to execute action '{}'".format(client.name, action))
             abort(403)
@@ -130,6 +132,24 @@ def command_api(client):
     return '', 204
 
 
+@app.route('/api/tasks')
+@api_auth_required(has_permission='tasks')
+def list_tasks(client, *args, **kwargs):
+    """
+    List running tasks and recently finished ones.
+    """
+    return jsonify([task.as_dict() for task in task_registry.list()])
+
+
+@app.route('/api/tasks/<task_id>/cancel', methods=['POST'])
+@api_auth_required(has_permission='tasks')
+def cancel_task(client, task_id, *args, **kwargs):
+    if task_registry.cancel(task_id):
+        app.logger.info("({}) Cancelled task {}".format(client.name, task_id))
+        return '', 204
+    abort(409)
+
+
 @app.route('/api/update', methods=['POST'])
 @api_auth_required(has_permission='update')
 def api_update_app(client, *args, **kwargs):
@@ -151,12 +171,13 @@ def update_app():
 def reload():
     if current_user.admin:
         try:
-            parser.parse("config.yml")
+            elapsed = parser.parse("config.yml", incremental=True)
         except Exception as e:
             app.logger.error(e)
             flash('Error in device config file. Please fix and reload.')
         else:
-            flash('Device config reload successful.')
+            app.logger.info("({}) Reloaded device config in {:.3f}s".format(current_user.username, elapsed))
+            flash('Device config reload successful ({:.2f}s).'.format(elapsed))
             socketio.emit('reload', {}, broadcast=True)
     return redirect(url_for('index'))
 
@@ -215,6 +236,8 @@ def login():
         user = User.get(username=username)
     except DoesNotExist:
         if USE_LDAP:
+            from ldap3.core.exceptions import LDAPException
+
             try:
                 user = ldap_auth(username, password)
                 created = True
@@ -287,10 +310,11 @@ def push_notify(client, data):
 @app.route("/displays/<disp>")
 @login_required
 def display(disp):
-    disp = get_display(disp)
+    registry = get_registry()
+    disp = registry.get_display(disp)
     if current_user.has_permission(disp):
         dashboard = disp.render()
-        widget_html = get_widgets(current_user) + get_action_widgets(current_user)
+        widget_html = get_widgets(current_user, registry) + get_action_widgets(current_user, registry)
         return render_template(disp.template or 'display.html',
                                dashboard=dashboard,
                                widgets=widget_html
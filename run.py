@@ -1,4 +1,15 @@
 #!/usr/bin/env python3
+import sys
+from time import perf_counter
+
+started = perf_counter()
+# Report how long startup and each module import took, then exit instead of serving
+PROFILE_STARTUP = '--profile-startup' in sys.argv
+if PROFILE_STARTUP:
+    from home.core.profiling import ImportProfiler
+
+    profiler = ImportProfiler()
+    profiler.install()
 
 try:
     import eventlet
@@ -27,8 +38,6 @@ import logging
 import os
 from logging.handlers import RotatingFileHandler
 
-import sys
-
 from home import settings
 from home.core.parser import parse
 from home.web.models import db_init
@@ -37,6 +46,12 @@ from home.web.web import socketio, app
 
 sys.path.append(os.path.dirname(os.path.realpath(__file__)))
 
+# Report how long each executor takes to run a task that does nothing, then exit
+if '--benchmark-dispatch' in sys.argv:
+    from home.core.profiling import benchmark_dispatch, print_benchmark
+
+    print_benchmark(benchmark_dispatch())
+    raise SystemExit
 db_init()
 
 try:
@@ -44,6 +59,11 @@ try:
 except FileNotFoundError:
     print("Error: Create `config.yml` before starting! Start with `example-config.yml`.")
     raise SystemExit
+if PROFILE_STARTUP:
+    profiler.uninstall()
+    profiler.print_report()
+    print("Ready to serve in {:.3f}s".format(perf_counter() - started))
+    raise SystemExit
 handler = RotatingFileHandler('home.log', maxBytes=10000, backupCount=1)
 handler.setLevel(logging.INFO)
 handler.setFormatter(logging.Formatter("%(asctime)s: %(message)s"))